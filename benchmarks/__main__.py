@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+# Run all the micro and macro benchmarks, and optionally save the results as
+# a baseline or compare them against one:
+#
+#     python -m benchmarks --save-baseline baseline.json
+#     ...upgrade demosh...
+#     python -m benchmarks --compare baseline.json
+
+import sys
+
+import argparse
+
+from . import bench_macro, bench_micro
+from .common import compare_baseline, save_baseline
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Run the demosh benchmarks')
+    parser.add_argument('--save-baseline', type=str, default=None, metavar='FILE',
+                        help="save the results as a baseline in FILE")
+    parser.add_argument('--compare', type=str, default=None, metavar='FILE',
+                        help="compare the results against the baseline in FILE")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="fractional slowdown that counts as a regression (default 0.2)")
+    parser.add_argument('--skip-macro', action='store_true', help="only run the micro benchmarks")
+    args = parser.parse_args()
+
+    print("Micro benchmarks:")
+    results = bench_micro.run()
+
+    if not args.skip_macro:
+        print("\nMacro benchmarks:")
+        results += bench_macro.run()
+
+    if args.save_baseline:
+        save_baseline(args.save_baseline, results)
+        print(f"\nSaved baseline to {args.save_baseline}")
+
+    if args.compare:
+        if not compare_baseline(args.compare, results, args.threshold, partial=args.skip_macro):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
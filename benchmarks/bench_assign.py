@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+# Compare the cost of evaluating assignments and cd the old way (a new bash,
+# fed the whole function prelude, for every statement) with the persistent
+# evaluator and the in-process fast path.
+
+from typing import Callable, List
+
+import sys
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from demosh.shellstate import ShellState
+
+
+def legacy_assign(shellstate: ShellState, name: str, value: str) -> int:
+    # This is how ShellState.do_assign used to work.
+    proc = subprocess.Popen(["bash"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            cwd=shellstate.cwd, env=shellstate.env, close_fds=True)
+
+    assert proc.stdin is not None   # hush, mypy
+
+    fn = shellstate.prelude.text()
+    stdout, _ = proc.communicate((fn + f'{name}={value}\necho "${name}"\n').encode('utf-8'))
+
+    if proc.returncode == 0:
+        shellstate.env[name] = stdout.decode('utf-8').strip()
+        return 0
+
+    return 1
+
+
+def legacy_cd(shellstate: ShellState, cmd: str) -> int:
+    # This is how ShellState.do_cd used to work.
+    proc = subprocess.Popen(["bash"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            cwd=shellstate.cwd, env=shellstate.env, close_fds=True)
+
+    stdout, _ = proc.communicate((cmd + "\npwd\n").encode('utf-8'))
+
+    if proc.returncode == 0:
+        shellstate.cwd = stdout.decode('utf-8').strip()
+        return 0
+
+    return 1
+
+
+def timeit(label: str, count: int, fn: Callable[[int], None]) -> float:
+    start = time.perf_counter()
+
+    for i in range(count):
+        fn(i)
+
+    elapsed = time.perf_counter() - start
+    per = elapsed / count
+
+    print(f"{label:<32} {count:6d} x {per * 1e6:10.1f} us = {elapsed:8.3f} s")
+    return per
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark assignment and cd evaluation')
+    parser.add_argument('--count', type=int, default=200, help="statements per benchmark")
+    parser.add_argument('--functions', type=int, default=20, help="number of functions in the prelude")
+    args = parser.parse_args()
+
+    shellstate = ShellState(sys.argv[0], "bench.sh", [])
+
+    for i in range(args.functions):
+        shellstate.prelude.define(f"fn{i}", f"fn{i}() {{\n    echo function {i} \"$@\"\n}}")
+
+    tmpdir = tempfile.mkdtemp()
+    shellstate.env["TMPBENCH"] = tmpdir
+    subdirs: List[str] = []
+
+    for i in range(10):
+        subdir = os.path.join(tmpdir, f"d{i}")
+        os.mkdir(subdir)
+        subdirs.append(subdir)
+
+    count = args.count
+
+    print(f"{count} statements, {args.functions} functions in the prelude\n")
+
+    results = []
+
+    results.append(("literal assignment",
+                    timeit("legacy literal assignment", count,
+                           lambda i: legacy_assign(shellstate, "FOO", f'"value {i}"')),
+                    timeit("fast-path literal assignment", count,
+                           lambda i: shellstate.do_assign(None, "FOO", f'"value {i}"'))))     # type: ignore
+
+    results.append(("command substitution",
+                    timeit("legacy $(...) assignment", count,
+                           lambda i: legacy_assign(shellstate, "FOO", f'"$(fn1 {i})"')),
+                    timeit("evaluator $(...) assignment", count,
+                           lambda i: shellstate.do_assign(None, "FOO", f'"$(fn1 {i})"'))))    # type: ignore
+
+    results.append(("literal cd",
+                    timeit("legacy cd", count,
+                           lambda i: legacy_cd(shellstate, f"cd {subdirs[i % 10]}")),
+                    timeit("fast-path cd", count,
+                           lambda i: shellstate.do_cd(None, f"cd {subdirs[i % 10]}"))))       # type: ignore
+
+    results.append(("cd with expansion",
+                    timeit("legacy cd $VAR", count,
+                           lambda i: legacy_cd(shellstate, f"cd $TMPBENCH/d{i % 10}")),
+                    timeit("evaluator cd $VAR", count,
+                           lambda i: shellstate.do_cd(None, f"cd $TMPBENCH/d{i % 10}"))))     # type: ignore
+
+    shellstate.close()
+    shutil.rmtree(tmpdir)
+
+    print()
+
+    for label, before, after in results:
+        print(f"{label:<24} {before / after:8.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+# Macro benchmarks: whole demos run headless (in batch mode, so with no
+# typeout and no waiting), and raw commands per second through
+# ShellState.do_shell_command.
+
+from typing import List
+
+import sys
+
+import argparse
+import os
+import shutil
+import tempfile
+
+from demosh.demostate import DemoState
+from demosh.shellstate import ShellState
+
+from .common import Result, measure, quiet
+
+
+ShellDemo = """#!/bin/bash
+# A synthetic demo: a mix of the kinds of things real demos do.
+#@SHOW
+mkdir -p work
+
+greet () {
+    echo "hello, $1"
+}
+
+"""
+
+ShellStep = """# Step %(i)d
+NAME%(i)d="step-%(i)d"
+cd work
+greet "$NAME%(i)d"
+#@immed
+echo "out of $(basename $PWD)" > /dev/null
+cd ..
+
+"""
+
+MarkdownDemo = """# A Synthetic Demo
+
+<!-- @SHOW -->
+
+```bash
+mkdir -p work
+```
+
+"""
+
+MarkdownStep = """## Step %(i)d
+
+This is *step %(i)d* of the demo, with **some** `markup` in it.
+
+```bash
+NAME%(i)d="step-%(i)d"
+cd work
+echo "hello, $NAME%(i)d"
+cd ..
+```
+
+"""
+
+
+def write_demo(directory: str, name: str, head: str, step: str, steps: int) -> str:
+    path = os.path.join(directory, name)
+
+    with open(path, "w") as f:
+        f.write(head)
+
+        for i in range(steps):
+            f.write(step % { "i": i })
+
+    return path
+
+
+def run_demo(path: str, mode: str, persistent: bool) -> None:
+    shellstate = ShellState(sys.argv[0], path, [], persistent=persistent)
+    shellstate.exit_on_failure = True
+
+    with open(path, "r") as script:
+        demostate = DemoState(shellstate, mode, script, load_init=False,
+                              batch=True, color=False)
+
+        try:
+            demostate.run()
+        finally:
+            shellstate.close()
+
+    if shellstate.failures:
+        raise Exception(f"{path}: {shellstate.failures} command(s) failed")
+
+
+def bench_demos(steps: int) -> List[Result]:
+    results: List[Result] = []
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+
+    try:
+        os.chdir(tmpdir)
+
+        shell_demo = write_demo(tmpdir, "demo.sh", ShellDemo, ShellStep, steps)
+        md_demo = write_demo(tmpdir, "demo.md", MarkdownDemo, MarkdownStep, steps)
+
+        for path, mode in ((shell_demo, "shell"), (md_demo, "markdown")):
+            for persistent in (False, True):
+                label = f"demo {mode} ({steps} steps{', persistent' if persistent else ''})"
+
+                with quiet():
+                    r = measure(label, lambda: run_demo(path, mode, persistent),
+                                number=1, repeat=3, unit="demo")
+
+                print(r)
+                results.append(r)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
+def bench_shell_command(count: int) -> List[Result]:
+    results: List[Result] = []
+
+    for persistent in (False, True):
+        shellstate = ShellState(sys.argv[0], "bench.sh", [], persistent=persistent)
+
+        for i in range(20):
+            shellstate.prelude.define(f"fn{i}", f"fn{i}() {{\n    echo function {i} \"$@\"\n}}")
+
+        label = f"do_shell_command{' (persistent)' if persistent else ''}"
+
+        with quiet():
+            r = measure(label, lambda: shellstate.do_shell_command(None, "fn1 hello"),     # type: ignore
+                        number=count, repeat=3, unit="command")
+
+        shellstate.close()
+
+        print(r)
+        results.append(r)
+
+    return results
+
+
+def run(steps: int=20, count: int=100) -> List[Result]:
+    return bench_demos(steps) + bench_shell_command(count)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Macro benchmarks for running whole demos')
+    parser.add_argument('--steps', type=int, default=20, help="steps in each synthetic demo")
+    parser.add_argument('--count', type=int, default=100, help="commands per do_shell_command run")
+    args = parser.parse_args()
+
+    run(args.steps, args.count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+# Micro benchmarks for demosh's in-process hot paths: reading scripts,
+# rendering Markdown, expanding the environment, and copying Commands.
+
+from typing import List
+
+import sys
+
+import argparse
+import os
+
+from demosh import markdown
+from demosh.command import Command, InputReader
+from demosh.demostate import DemoState
+from demosh.shellstate import ShellState
+
+from .common import Result, measure, markdown_script, markdown_text, shell_script
+
+
+def bench_read_element(scale: int) -> List[Result]:
+    results: List[Result] = []
+
+    shell_lines = shell_script(200 * scale)
+    md_lines = markdown_script(20 * scale)
+
+    for mode, lines in (("shell", shell_lines), ("markdown", md_lines)):
+        def read() -> None:
+            reader = InputReader(mode, iter(lines))
+
+            for _ in reader.read_element():
+                pass
+
+        results.append(measure(f"read_element {mode} ({len(lines)} lines)", read,
+                               number=5, repeat=5, unit="script"))
+
+    return results
+
+
+def bench_markdownify(scale: int) -> List[Result]:
+    # Use a real terminal type so that the caps aren't all empty.
+    os.environ.setdefault("TERM", "xterm-256color")
+
+    shellstate = ShellState(sys.argv[0], "bench.md", [])
+    demostate = DemoState(shellstate, "markdown", iter([]), load_builtins=False,
+                          load_init=False, batch=True)
+
+    text = markdown_text(200 * scale)
+    caps = (demostate.start_color(1), demostate.start_color(2), demostate.start_color(4),
+            demostate.start_color(5), demostate.start_bold(), demostate.end_bold(),
+            demostate.start_underline(), demostate.end_underline(), demostate.end_color())
+
+    renderer = markdown.renderer(caps)
+
+    results = [
+        measure(f"markdownify cold ({len(text)} chars)", lambda: demostate.markdownify(text),
+                number=1, repeat=20, setup=renderer._cache.clear),
+        measure(f"markdownify cached ({len(text)} chars)", lambda: demostate.markdownify(text),
+                number=1000, repeat=5),
+    ]
+
+    shellstate.close()
+    return results
+
+
+def bench_expand_env(scale: int) -> List[Result]:
+    shellstate = ShellState(sys.argv[0], "bench.sh", [ "one", "two" ])
+    count = 1000 * scale
+
+    for i in range(count):
+        shellstate.setenv(f"BENCH_VAR_{i}", f"value-{i}")
+
+    shellstate.setenv("BENCH_CHANGING", "x")
+
+    refs = " ".join(f"${{BENCH_VAR_{i * 7}}} $BENCH_VAR_{i * 3} ${{UNSET_{i}:-dflt}} $1"
+                    for i in range(20))
+
+    def cold() -> None:
+        # Changing the environment throws away the expansion cache.
+        shellstate.setenv("BENCH_CHANGING", "x")
+        shellstate.expand_env(refs, bare=True)
+
+    # Name these after the variables we added, not len(shellstate.env),
+    # which depends on whatever environment we were run from.
+    results = [
+        measure(f"expand_env cold ({count} vars)", cold, number=200, repeat=5),
+        measure(f"expand_env cached ({count} vars)",
+                lambda: shellstate.expand_env(refs, bare=True), number=10000, repeat=5),
+    ]
+
+    shellstate.close()
+    return results
+
+
+def bench_command_copy(scale: int) -> List[Result]:
+    cmd = Command("echo hello world", markdown=True)
+    cmd.wait_after = True
+
+    return [ measure("Command.copy", cmd.copy, number=10000 * scale, repeat=5) ]
+
+
+def run(scale: int=1) -> List[Result]:
+    results: List[Result] = []
+
+    for bench in (bench_read_element, bench_markdownify, bench_expand_env, bench_command_copy):
+        for r in bench(scale):
+            print(r)
+            results.append(r)
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Micro benchmarks for demosh hot paths')
+    parser.add_argument('--scale', type=int, default=1, help="multiply the size of the synthetic inputs")
+    args = parser.parse_args()
+
+    run(args.scale)
+
+
+if __name__ == "__main__":
+    main()
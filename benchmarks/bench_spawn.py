@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+# Compare the cost of starting a child process the old way (with a
+# preexec_fn to reset signals, which forces a full fork of the Python
+# process) with demosh.launcher.spawn. The difference grows with the size of
+# the parent, so this can pad the parent out with some ballast first.
+
+import argparse
+import subprocess
+
+from demosh import launcher
+
+from .common import measure
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark process spawn latency')
+    parser.add_argument('--count', type=int, default=200, help="spawns per benchmark")
+    parser.add_argument('--ballast', type=int, default=256, help="MB of memory to make resident in the parent first")
+    args = parser.parse_args()
+
+    # Touch every page so that the ballast is actually resident.
+    ballast = bytearray(args.ballast * 1024 * 1024)
+
+    for i in range(0, len(ballast), 4096):
+        ballast[i] = 1
+
+    launcher.ignore_signals()
+
+    def legacy() -> None:
+        subprocess.Popen(["/bin/true"], close_fds=True, preexec_fn=launcher.reset_signals).wait()
+
+    def fast() -> None:
+        launcher.spawn(["/bin/true"], close_fds=True).wait()
+
+    print(f"{args.count} spawns, {args.ballast}MB ballast\n")
+
+    before = measure("spawn with preexec_fn", legacy, number=args.count, repeat=3, unit="spawn")
+    print(before)
+
+    after = measure("launcher.spawn", fast, number=args.count, repeat=3, unit="spawn")
+    print(after)
+
+    print(f"\n{before.seconds / after.seconds:.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+# Shared machinery for the benchmarks: timing, synthetic inputs, quieting
+# output, and saving and comparing results against a baseline.
+
+from typing import Callable, Dict, Iterator, List, Optional
+
+import sys
+
+import contextlib
+import json
+import os
+import random
+import time
+
+
+class Result:
+    def __init__(self, name: str, seconds: float, unit: str="call", count: int=1) -> None:
+        # seconds is the best time for one unit (one call, one command, etc.)
+        self.name = name
+        self.seconds = seconds
+        self.unit = unit
+        self.count = count
+
+    def __str__(self) -> str:
+        per_second = (1.0 / self.seconds) if self.seconds else float("inf")
+        return f"{self.name:<44} {self.seconds * 1e6:12.1f} us/{self.unit:<8} {per_second:12.1f} {self.unit}s/s"
+
+
+def measure(name: str, fn: Callable[[], None], number: int=10, repeat: int=5,
+            unit: str="call", setup: Optional[Callable[[], None]]=None) -> Result:
+    # Call fn number times, repeat times over, and report the best per-call
+    # time. The best is the least noisy estimate of what the code costs.
+    times: List[float] = []
+
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+
+        started = time.perf_counter()
+
+        for _ in range(number):
+            fn()
+
+        times.append((time.perf_counter() - started) / number)
+
+    return Result(name, min(times), unit=unit, count=number * repeat)
+
+
+@contextlib.contextmanager
+def quiet() -> Iterator[None]:
+    # Send everything written to stdout and stderr -- by us or by child
+    # processes -- to /dev/null.
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    saved = [ os.dup(1), os.dup(2) ]
+    devnull = os.open(os.devnull, os.O_WRONLY)
+
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+        os.close(devnull)
+
+
+# Synthetic inputs. These use a fixed seed so that every run benchmarks the
+# same thing.
+
+Words = ("demo", "linkerd", "mesh", "proxy", "cluster", "service", "traffic",
+         "latency", "request", "policy", "route", "namespace", "deploy")
+
+
+def prose(rng: random.Random, words: int) -> str:
+    out: List[str] = []
+
+    for i in range(words):
+        word = rng.choice(Words)
+        r = rng.random()
+
+        if r < 0.05:
+            word = f"*{word}*"
+        elif r < 0.08:
+            word = f"**{word}**"
+        elif r < 0.12:
+            word = f"`{word}`"
+        elif r < 0.14:
+            word = f"_{word}_"
+
+        out.append(word)
+
+        if (i % 12) == 11:
+            out.append("\n")
+
+    return " ".join(out)
+
+
+def shell_script(commands: int, seed: int=1) -> List[str]:
+    rng = random.Random(seed)
+    lines: List[str] = [ "#!/bin/bash\n" ]
+
+    for i in range(commands):
+        kind = i % 5
+
+        if kind == 0:
+            lines.append(f"# Step {i}: {rng.choice(Words)} {rng.choice(Words)}\n")
+            lines.append("#@SHOW\n" if (i % 50) == 0 else "\n")
+        elif kind == 1:
+            lines.append(f"VAR{i}=\"{rng.choice(Words)}-{i}\"\n")
+        elif kind == 2:
+            lines.append(f"fn{i}() {{\n")
+            lines.append(f"    echo \"{rng.choice(Words)} $1\"\n")
+            lines.append("}\n")
+        elif kind == 3:
+            lines.append("#@immed\n")
+            lines.append(f"echo {rng.choice(Words)} \\\n")
+            lines.append(f"    {rng.choice(Words)}\n")
+        else:
+            lines.append(f"true {i}\n")
+
+    return lines
+
+
+def markdown_script(sections: int, seed: int=1) -> List[str]:
+    rng = random.Random(seed)
+    text: List[str] = []
+
+    for i in range(sections):
+        text.append(f"## Section {i}\n\n")
+        text.append(prose(rng, 120) + "\n\n")
+        text.append(f"* {rng.choice(Words)} item\n- [{rng.choice(Words)}](https://example.com/{i})\n\n")
+        text.append("```bash\n")
+        text.append(f"VAR{i}=\"{rng.choice(Words)}\"\n")
+        text.append("true \"$VAR\"\n")
+        text.append("```\n\n")
+
+        if (i % 10) == 0:
+            text.append("<!-- @SHOW -->\n\n")
+
+    return "".join(text).splitlines(keepends=True)
+
+
+def markdown_text(words: int, seed: int=1) -> str:
+    rng = random.Random(seed)
+    return "# A Header\n\n" + prose(rng, words) + "\n"
+
+
+# Baselines are just JSON: { name: seconds-per-unit }.
+
+def save_baseline(path: str, results: List[Result]) -> None:
+    with open(path, "w") as f:
+        json.dump({ r.name: r.seconds for r in results }, f, indent=2, sort_keys=True)
+
+
+def compare_baseline(path: str, results: List[Result], threshold: float,
+                     partial: bool=False) -> bool:
+    # Print how each result compares to the baseline, and return False if
+    # anything got slower by more than threshold (e.g. 0.2 for 20%), or if
+    # something in the baseline didn't get run at all (since then we can't
+    # tell whether it got slower). If partial is set, we know we didn't run
+    # everything, so missing results are only a warning.
+    with open(path, "r") as f:
+        baseline: Dict[str, float] = json.load(f)
+
+    ok = True
+
+    print(f"\nCompared to {path}:")
+
+    names = set(r.name for r in results)
+
+    for name in sorted(baseline.keys()):
+        if name not in names:
+            print(f"  {name:<44} (missing from this run)")
+
+            if not partial:
+                ok = False
+
+    for r in results:
+        before = baseline.get(r.name, None)
+
+        if before is None:
+            print(f"  {r.name:<44} (new)")
+            continue
+
+        ratio = r.seconds / before if before else float("inf")
+        flag = ""
+
+        if ratio > 1.0 + threshold:
+            flag = "  << SLOWER"
+            ok = False
+        elif ratio < 1.0 / (1.0 + threshold):
+            flag = "  faster"
+
+        print(f"  {r.name:<44} {ratio:6.2f}x{flag}")
+
+    return ok
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+from typing import Any, Dict, List, TYPE_CHECKING
+
+import sys
+
+import json
+import os
+import tempfile
+
+from . import __version__
+
+if TYPE_CHECKING:
+    from .demostate import DemoState
+    from .shellstate import ShellState
+
+
+# A Checkpoint is a snapshot of everything demosh needs to pick a demo back up
+# where it left off: the ShellState (environment, working directory,
+# functions, hooks, and "set -e") plus where we were in the script. Since
+# macros and #@ifhook blocks run their own DemoStates, "where we were" is a
+# stack with one entry per level of nesting.
+#
+# Note that a checkpoint only knows what demosh knows. Anything that lives
+# only inside a shell (with --persistent-shell, unexported variables, say)
+# isn't in it.
+class Checkpoint:
+    # Bump this if the format of the checkpoint file changes.
+    FORMAT = 3
+
+    def __init__(self, path: str, script: str, debug: bool=False) -> None:
+        self.path = path
+        self.script = script if (script == "-") else os.path.abspath(script)
+        self.debug = debug
+
+        # The DemoStates that are currently running, outermost first.
+        self.stack: List['DemoState'] = []
+
+    def enter(self, demostate: 'DemoState') -> None:
+        self.stack.append(demostate)
+
+    def leave(self) -> None:
+        self.stack.pop()
+
+    def save(self, shellstate: 'ShellState') -> None:
+        # For every level but the innermost, cmd_index has already moved past
+        # the instruction that's running the next level in, so we back up to
+        # it: resuming means running it again.
+        levels: List[Dict[str, Any]] = []
+        innermost = len(self.stack) - 1
+
+        for i, demostate in enumerate(self.stack):
+            index = demostate.cmd_index
+
+            if i < innermost:
+                index -= 1
+
+            levels.append({ "index": index, "showing": demostate.showing })
+
+        data = {
+            "format": Checkpoint.FORMAT,
+            "version": __version__,
+            "script": self.script,
+            "env": shellstate.env,
+            "cwd": shellstate.cwd,
+            "functions": shellstate.prelude.items(),
+            "hooks": sorted(shellstate._hooks),
+            "errexit": shellstate.errexit,
+            "levels": levels,
+        }
+
+        try:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmppath = tempfile.mkstemp(dir=directory, suffix=".tmp")
+
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+
+            os.replace(tmppath, self.path)
+        except OSError as e:
+            if self.debug:
+                print(f"Could not save checkpoint {self.path}: {e}")
+
+    def restore(self, shellstate: 'ShellState', path: str) -> bool:
+        # Load the checkpoint in path into shellstate, and arrange for the next
+        # DemoState.run to resume from it. Returns False if there's nothing
+        # usable to restore.
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            sys.stderr.write(f"Could not read checkpoint {path}: {e}\n")
+            return False
+
+        if data.get("format") != Checkpoint.FORMAT:
+            sys.stderr.write(f"Checkpoint {path} is from an incompatible version of demosh\n")
+            return False
+
+        if data.get("script") != self.script:
+            sys.stderr.write(f"Checkpoint {path} is for {data.get('script')}, not {self.script}\n")
+            return False
+
+        shellstate.env = dict(data["env"])
+        shellstate.env_generation += 1
+        shellstate.cwd = data["cwd"]
+        shellstate.prelude.load([ (name, definition) for name, definition in data["functions"] ])
+        shellstate._hooks = set(data["hooks"])
+        shellstate.errexit = bool(data["errexit"])
+        shellstate.exit_on_failure = shellstate.errexit
+        shellstate.resume = list(data["levels"])
+
+        return True
@@ -61,6 +61,14 @@ class Command:
         self.wait_before = True
         self.wait_after = False
         self.explicit_wait = False
+        self.setup = False
+        self.prefetch = False
+
+        # If set, run in the background as a job with this name.
+        self.background = ""
+
+        # If nonzero, cache this command's output for this many seconds.
+        self.cache = 0.0
 
     def copy(self) -> 'Command':
         c2 = Command(self.cmdline, comment=self.comment, markdown=self.markdown,
@@ -72,6 +80,10 @@ class Command:
         c2.wait_before = self.wait_before
         c2.wait_after = self.wait_after
         c2.explicit_wait = self.explicit_wait
+        c2.setup = self.setup
+        c2.prefetch = self.prefetch
+        c2.background = self.background
+        c2.cache = self.cache
 
         return c2
 
@@ -133,11 +145,15 @@ class Command:
         return bool(self.conditional)
 
 class InputReader:
-    def __init__(self, mode: str, input: Iterator[str]) -> None:
+    def __init__(self, mode: str, input: Iterator[str], path: Optional[str]=None) -> None:
         self.mode = mode
         self.markdown_allowed = (mode == "markdown")
         self.input = input
 
+        # The file we're reading, if it is one, so that imports can be
+        # relative to it.
+        self.path = path
+
     def parse_directive(self, line: str) -> Union[RawSingleValue, RawMultiValue]:
         if line.startswith("#@hook "):
             # This is a hook function.
@@ -160,6 +176,19 @@ class InputReader:
 
             return RawMultiValue("macro", macroname, macro)
 
+        elif (line == "#@parallel") or line.startswith("#@parallel "):
+            block: List[str] = []
+
+            while True:
+                l2 = next(self.input)
+
+                if l2.rstrip() == "#@end":
+                    break
+
+                block.append(l2.lstrip())
+
+            return RawMultiValue("parallel", "parallel", block)
+
         elif line.startswith("#@import"):
             _, path = line.strip().split(" ", 1)
 
@@ -201,7 +230,9 @@ class InputReader:
                 if (line.startswith("#@hook ") or
                     line.startswith("#@macro ") or
                     line.startswith("#@import ") or
-                    line.startswith("#@ifhook ")):
+                    line.startswith("#@ifhook ") or
+                    (line.rstrip() == "#@parallel") or
+                    line.startswith("#@parallel ")):
                     if buf:
                         raise Exception("Can't have a directive in a compound statement")
 
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+from typing import Dict, Iterable, List, Optional, Union
+
+import math
+
+from .command import Command
+from .shellstate import parse_duration, parse_waitfor
+
+
+# Instructions are what DemoState.run actually executes. The compiler turns
+# the Commands read from the script into instructions once, up front, so that
+# run doesn't have to figure out what each Command is every time it steps.
+#
+# The opcodes are:
+#
+# blank:   display a blank line (folded, like the shell does)
+# display: display commentary (cmd is the comment)
+# typeout: type out commentary slowly (text is what to type)
+# setflag: set a DemoState flag (flag is its name, value is what to set)
+# ifhook:  run cmd.demostate if the hook named by cmd.cmdline is present
+# exec:    execute cmd, which already has all its modifiers applied
+# label:   mark a place --start-at can jump to (text is the label)
+# parallel: run the commands in cmd.demostate concurrently
+# invalid: complain about an invalid conditional
+
+class Instruction:
+    def __init__(self, op: str, cmd: Optional[Command]=None, text: str="",
+                 flag: str="", value: bool=False) -> None:
+        self.op = op
+        self.cmd = cmd
+        self.text = text
+        self.flag = flag
+        self.value = value
+
+        # For exec instructions, base is the original Command before any
+        # modifiers were applied, and repeatable says whether the "repeat"
+        # action can land on this instruction.
+        self.base: Optional[Command] = None
+        self.repeatable = False
+
+        # hidden is set at runtime if the instruction runs while we're not
+        # showing things.
+        self.hidden = False
+
+    def __str__(self) -> str:
+        if self.op == "setflag":
+            return f"<{self.op} {self.flag}={self.value}>"
+
+        if self.op == "typeout":
+            return f"<{self.op} {self.text}>"
+
+        return f"<{self.op} {self.cmd}>"
+
+
+class Compiler:
+    # Directives that are commands in their own right, rather than modifiers
+    # for the next command.
+    Standalones = {
+        "checkfor",
+        "print",
+    }
+
+    # Directives that just set (or clear) a flag on the next command.
+    Modifiers: Dict[str, Dict[str, bool]] = {
+        "waitafter": { "wait_after": True },
+        "nowaitbefore": { "wait_before": False },
+        "noshow": { "type_command": False },
+        "notypeout": { "typeout": False },
+        "immed": { "wait_before": False, "wait_after": False, "type_command": False },
+        "immediate": { "wait_before": False, "wait_after": False, "type_command": False },
+        "setup": { "setup": True },
+        "prefetch": { "prefetch": True },
+    }
+
+    def __init__(self) -> None:
+        # Modifiers waiting for the next command to execute.
+        self.pending: Dict[str, Union[bool, float, str]] = {}
+
+        # Are we skipping everything until the next #@SHOW?
+        self.skipping = False
+
+    def compile_all(self, commands: Iterable[Command]) -> List[Instruction]:
+        instructions: List[Instruction] = []
+
+        for cmd in commands:
+            instr = self.compile(cmd)
+
+            if instr is not None:
+                instructions.append(instr)
+
+        return instructions
+
+    def compile(self, cmd: Command) -> Optional[Instruction]:
+        # Compile a single Command. This returns None for things that don't
+        # need to do anything at runtime (hidden comments, skipped stuff,
+        # and modifiers, which get folded into the next exec).
+        if self.skipping:
+            if cmd.cmdline.strip() != "#@SHOW":
+                return None
+
+            self.skipping = False
+
+        if cmd.isblank():
+            return Instruction("blank", cmd)
+
+        if cmd.iscomment():
+            if cmd.ishiddencomment():
+                return None
+
+            if not cmd.ismeta():
+                if cmd.cmdline.startswith("#$"):
+                    return Instruction("typeout", cmd, text=cmd.cmdline[2:].strip())
+
+                return Instruction("display", cmd)
+
+            cs = cmd.cmdline[2:].strip()
+
+            if cs == "SKIP":
+                self.skipping = True
+                return None
+            elif cs == "SHOW":
+                return Instruction("setflag", cmd, flag="showing", value=True)
+            elif cs == "HIDE":
+                return Instruction("setflag", cmd, flag="showing", value=False)
+            elif cs.startswith("label ") or (cs == "label"):
+                return Instruction("label", cmd, text=cs[5:].strip())
+            elif (cs == "cache") or cs.startswith("cache "):
+                arg = cs[5:].strip()
+                ttl = parse_duration(arg) if arg else math.inf
+
+                if not ttl:
+                    # Not a valid TTL (or a zero one, which would never
+                    # cache anything).
+                    raise Exception(f"Invalid TTL for #@cache: {arg}")
+
+                self.pending["cache"] = ttl
+                return None
+            elif cs.startswith("waitfor "):
+                # Check the timeout now, rather than partway through the demo.
+                try:
+                    parse_waitfor(cs)
+                except ValueError as e:
+                    raise Exception(f"Invalid #@waitfor: {e}")
+
+                return self.compile_exec(cmd, {
+                    'wait_before': False,
+                    'wait_after': False,
+                    'type_command': False,
+                })
+            elif cs.startswith("background "):
+                self.pending["background"] = cs[11:].strip()
+                return None
+            elif cs in Compiler.Modifiers:
+                self.pending.update(Compiler.Modifiers[cs])
+                return None
+            elif cs in Compiler.Standalones:
+                # This is a standalone command, not a modifier for the next command.
+                return self.compile_exec(cmd, {
+                    'wait_before': False,
+                    'wait_after': True,
+                    'type_command': False,
+                })
+            elif cs == "wait":
+                # This is a standalone command, not a modifier for the next command.
+                return self.compile_exec(cmd, {
+                    'wait_before': False,
+                    'wait_after': True,
+                    'type_command': False,
+                    'explicit_wait': True,
+                })
+            else:
+                # Any other directive is an immediate command.
+                return self.compile_exec(cmd, {
+                    'wait_before': False,
+                    'wait_after': False,
+                    'type_command': False,
+                })
+
+        if cmd.isconditional():
+            if cmd.conditional == "ifhook":
+                return Instruction("ifhook", cmd)
+
+            if cmd.conditional == "parallel":
+                return Instruction("parallel", cmd)
+
+            return Instruction("invalid", cmd)
+
+        return self.compile_exec(cmd, {})
+
+    def compile_exec(self, cmd: Command, overrides: Dict[str, bool]) -> Instruction:
+        # Fold any pending modifiers, then the command's own overrides, into
+        # a copy of the command.
+        final = cmd.copy()
+
+        for k, v in self.pending.items():
+            setattr(final, k, v)
+
+        for k, v in overrides.items():
+            setattr(final, k, v)
+
+        self.pending = {}
+
+        instr = Instruction("exec", final)
+        instr.base = cmd
+        instr.repeatable = not cmd.iscomment()
+
+        return instr
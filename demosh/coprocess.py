@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+from typing import Dict, List, Optional, Set, Tuple, TYPE_CHECKING
+
+import os
+import re
+import shlex
+import subprocess
+
+from . import launcher
+
+if TYPE_CHECKING:
+    from .shellstate import ShellState
+
+
+# Only variables with names like this can be synced into the coprocess.
+reVarName = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
+
+# This is the driver loop that the coprocess runs. It reads NUL-terminated
+# requests from one pipe, each of which is the name of a variable (which may
+# be empty) followed by a command. It evals the command, then writes the exit
+# status, the value of the variable, and the working directory, NUL-terminated,
+# back on another pipe. The pipes are closed around the eval so that commands
+# can't trample them.
+#
+# The variable is there so that assignments can be evaluated in the same
+# round trip as reading the result back. Since demosh always exports its
+# variables, it gets exported too.
+#
+# The INT trap is here so that hitting ^C while a command is running kills
+# the command, but not the coprocess itself.
+DRIVER = r'''
+trap : INT
+while IFS= read -r -d '' __demosh_var <&%(cmdfd)d && IFS= read -r -d '' __demosh_cmd <&%(cmdfd)d; do
+    eval "$__demosh_cmd" %(cmdfd)d<&- %(statfd)d>&-
+    __demosh_rc=$?
+    __demosh_value=
+    if [ -n "$__demosh_var" ]; then
+        export "$__demosh_var"
+        __demosh_value="${!__demosh_var}"
+    fi
+    printf '%%d\0%%s\0%%s\0' "$__demosh_rc" "$__demosh_value" "$PWD" >&%(statfd)d
+done
+'''
+
+
+# A Coprocess is a long-lived bash that runs commands on behalf of a
+# ShellState, so that we don't pay for a fork/exec and the whole function
+# prelude on every command, and so that shell-local state survives between
+# commands.
+class Coprocess:
+    def __init__(self, shell: str="bash") -> None:
+        self.shell = shell
+        self.proc: Optional[subprocess.Popen] = None
+        self._cmd_w: Optional[int] = None
+        self._stat_r: Optional[int] = None
+        self._pending = b""
+
+        # What the coprocess currently has, so that we only send changes.
+        self._env: Dict[str, str] = {}
+        self._cwd: Optional[str] = None
+        self._prelude: Optional[str] = None
+        self._function_names: Set[str] = set()
+
+    def alive(self) -> bool:
+        return (self.proc is not None) and (self.proc.poll() is None)
+
+    def start(self, shellstate: 'ShellState') -> None:
+        cmd_r, cmd_w = os.pipe()
+        stat_r, stat_w = os.pipe()
+
+        driver = DRIVER % { "cmdfd": cmd_r, "statfd": stat_w }
+
+        self.proc = launcher.spawn([self.shell, "-c", driver],
+                                   cwd=shellstate.cwd, env=shellstate.env,
+                                   stdin=shellstate.stdin,
+                                   close_fds=True, pass_fds=(cmd_r, stat_w))
+
+        os.close(cmd_r)
+        os.close(stat_w)
+
+        self._cmd_w = cmd_w
+        self._stat_r = stat_r
+        self._pending = b""
+
+        self._env = dict(shellstate.env)
+        self._cwd = shellstate.cwd
+        self._prelude = None
+        self._function_names = set()
+
+    def close(self) -> None:
+        if self._cmd_w is not None:
+            os.close(self._cmd_w)
+            self._cmd_w = None
+
+        if self._stat_r is not None:
+            os.close(self._stat_r)
+            self._stat_r = None
+
+        if self.proc is not None:
+            try:
+                self.proc.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+
+            self.proc = None
+
+    def sync(self, shellstate: 'ShellState') -> List[str]:
+        # Figure out what has to be sent to bring the coprocess up to date
+        # with the ShellState: functions (if they changed at all, we unset
+        # any that went away and re-source the prelude), changed environment
+        # variables, and the working directory.
+        lines: List[str] = []
+
+        prelude = shellstate.prelude
+
+        if prelude.digest() != self._prelude:
+            names = set(prelude.names())
+
+            for name in sorted(self._function_names - names):
+                lines.append(f"unset -f {name}")
+
+            if names:
+                lines.append(prelude.source_line())
+
+            self._prelude = prelude.digest()
+            self._function_names = names
+
+        for k, v in shellstate.env.items():
+            if (self._env.get(k, None) != v) and reVarName.match(k):
+                lines.append(f"export {k}={shlex.quote(v)}")
+
+        for k in self._env.keys():
+            if (k not in shellstate.env) and reVarName.match(k):
+                lines.append(f"unset {k}")
+
+        self._env = dict(shellstate.env)
+
+        if self._cwd != shellstate.cwd:
+            lines.append(f"cd -- {shlex.quote(shellstate.cwd)}")
+            self._cwd = shellstate.cwd
+
+        return lines
+
+    def send(self, text: str) -> None:
+        assert self._cmd_w is not None  # hush, mypy
+
+        data = text.encode('utf-8') + b"\0"
+
+        while data:
+            written = os.write(self._cmd_w, data)
+            data = data[written:]
+
+    def read_field(self) -> Optional[str]:
+        assert self._stat_r is not None  # hush, mypy
+
+        while b"\0" not in self._pending:
+            chunk = os.read(self._stat_r, 4096)
+
+            if not chunk:
+                return None
+
+            self._pending += chunk
+
+        field, self._pending = self._pending.split(b"\0", 1)
+        return field.decode('utf-8')
+
+    def read_status(self) -> Optional[Tuple[int, str, str]]:
+        rc = self.read_field()
+        value = self.read_field()
+        cwd = self.read_field()
+
+        if (rc is None) or (value is None) or (cwd is None):
+            return None
+
+        return int(rc), value, cwd
+
+    def evaluate(self, shellstate: 'ShellState', cmd: str, var: str="") -> Tuple[int, str, str]:
+        # Run cmd, and return its exit status, the value of var afterward,
+        # and the working directory afterward, all in one round trip.
+        if not self.alive():
+            self.close()
+            self.start(shellstate)
+
+        lines = self.sync(shellstate)
+        lines.append(cmd)
+
+        try:
+            self.send(var)
+            self.send("\n".join(lines))
+        except BrokenPipeError:
+            # The coprocess died out from under us (probably someone ran
+            # "exit"). Start over next time.
+            self.close()
+            return 127, "", shellstate.cwd
+
+        status = self.read_status()
+
+        if status is None:
+            # The coprocess exited while running the command, so the command
+            # itself must have caused that. Report the shell's exit status.
+            assert self.proc is not None  # hush, mypy
+            rc = self.proc.wait()
+            self.close()
+            return rc, "", shellstate.cwd
+
+        rc, value, cwd = status
+        self._cwd = cwd
+
+        if var:
+            # The coprocess already has this value, so don't send it again.
+            self._env[var] = value
+
+        return rc, value, cwd
+
+    def run(self, shellstate: 'ShellState', cmd: str) -> int:
+        rc, _, cwd = self.evaluate(shellstate, cmd)
+        shellstate.cwd = cwd
+
+        return rc
@@ -22,38 +22,52 @@
 # For more info, see README.md. If you've somehow found demosh without also
 # finding its repo, it's at github.com/BuoyantIO/demosh.
 
-from typing import Any, Dict, Iterator, List, Optional, Set, TYPE_CHECKING
+from typing import Dict, Iterable, Iterator, List, Optional, Union, TYPE_CHECKING
 
 import sys
 
 import curses
 import os
-import random
-import select
-import termios
+import re
 from .builtins import script as builtin_script
 
+from . import markdown
+from .checkpoint import Checkpoint
 from .command import RawSingleValue, RawMultiValue, Command, InputReader
+from .compiler import Compiler, Instruction
+from .imports import ImportResolver
+from .parsecache import ParseCache
+from .profiler import PROFILER, profiled
+from .shellstate import reAssignment, reFunction
+from .terminal import Terminal
+from .trace import Step, Tracer
+from .typeout import Typeout
 
 if TYPE_CHECKING:
     from .shellstate import ShellState
 
 
-def chardelay() -> float:
-    return random.uniform(0.01, 0.1)
+# What a Markdown heading looks like, for --start-at.
+reHeading = re.compile(r"^\s*#+\s+(.*?)\s*$")
 
 
 class DemoState:
-    Standalones = {
-        "checkfor",
-        "print",
-    }
-
     def __init__(self, shellstate: 'ShellState', mode: str, script: Iterator[str],
                  parent: Optional['DemoState']=None,
                  debug: Optional[bool]=False,
                  load_builtins: Optional[bool]=True,
-                 load_init: Optional[bool]=True) -> None:
+                 load_init: Optional[bool]=True,
+                 parse_cache: Optional[ParseCache]=None,
+                 typeout: Optional[Typeout]=None,
+                 lazy: Optional[bool]=False,
+                 input_fd: Optional[int]=None,
+                 batch: Optional[bool]=False,
+                 color: Optional[bool]=True,
+                 tracer: Optional[Tracer]=None,
+                 checkpoint: Optional[Checkpoint]=None,
+                 prefetch: Optional[bool]=True,
+                 path: Optional[str]=None,
+                 imports: Optional[ImportResolver]=None) -> None:
         self._level: int = parent._level + 1 if parent else 0
         self.debug = False
 
@@ -64,19 +78,63 @@ class DemoState:
 
         self.parent = parent
         self.mode = mode
-        self.skipping = False
+
+        if parent is not None:
+            parse_cache = parent.parse_cache
+
+        self.parse_cache: Optional[ParseCache] = parse_cache
+
+        if parent is not None:
+            imports = parent.imports
+        elif imports is None:
+            imports = ImportResolver(debug=bool(debug))
+
+            if path is not None:
+                imports.root(path)
+
+        self.imports: ImportResolver = imports
+
+        if parent is not None:
+            typeout = parent.typeout
+        elif typeout is None:
+            typeout = Typeout()
+
+        self.typeout: Typeout = typeout
+
+        # In batch mode, there's no terminal: we don't wait, we don't type
+        # things out, and we stop at the first failure.
+        if parent is not None:
+            batch = parent.batch
+            color = parent.use_color
+
+        self.batch: bool = bool(batch)
+        self.use_color: bool = bool(color)
+
+        if parent is not None:
+            tracer = parent.tracer
+
+        self.tracer: Optional[Tracer] = tracer
+
+        if parent is not None:
+            checkpoint = parent.checkpoint
+
+        self.checkpoint: Optional[Checkpoint] = checkpoint
+
+        # #@prefetch only happens at the top level (and not at all if we're
+        # just reading the script, e.g. for --compile). It waits until run
+        # knows where we're starting, so that --start-at and --resume don't
+        # prefetch commands they're going to skip.
+        self.prefetching = bool(prefetch) and (parent is None)
+        self._prefetch_from: Optional[int] = None
         self.showing = False
         self.echo_blanks = False
         self.shellstate = shellstate
         self._end_color: Optional[str] = None
         self._colors: Dict[str, str] = {}
-        self._sane: Optional[List[Any]] = None
-        self._cbreak: Optional[List[Any]] = None
-        self._raw: Optional[List[Any]] = None
 
         self._overrides: Dict[str, bool] = {}
 
-        self.reader = InputReader(mode, script)
+        self.reader = InputReader(mode, script, path=path)
 
         self._action_chars = {
             # 'q':  "quit",
@@ -87,20 +145,30 @@ class DemoState:
             '+':  "skip",
         }
 
-        self.fd = sys.stdin.fileno()
+        if input_fd is None:
+            input_fd = sys.stdin.fileno()
+
+        self.fd = input_fd
 
         if self.parent is not None:
-            # We have a parent. Copy its termios settings...
-            self._sane = self.parent._sane
-            self._cbreak = self.parent._cbreak
-            self._raw = self.parent._raw
+            # We have a parent. Share its terminal...
+            self.terminal: Terminal = self.parent.terminal
         else:
-            # No parent. Actually set termios stuff ourselves...
-            self.setup_termios()
+            # No parent. Actually set up the terminal ourselves...
+            self.terminal = Terminal(self.fd, enabled=not self.batch)
 
             # ...and initialize curses -- not for whole-hog screen
-            # management, just for terminfo access.
-            curses.setupterm()
+            # management, just for terminfo access. In batch mode we might
+            # not have a usable terminal, in which case we do without color.
+            if self.use_color:
+                try:
+                    with PROFILER.phase("startup: setupterm"):
+                        curses.setupterm(fd=sys.stdout.fileno())
+                except curses.error:
+                    if not self.batch:
+                        raise
+
+                    self.use_color = False
 
         self.commands: List[Command] = []
 
@@ -108,19 +176,22 @@ class DemoState:
             if self.debug:
                 print("Loading builtins...")
 
-            self.read_commands(shellstate, InputReader("shell", iter(builtin_script.split("\n"))))
+            with PROFILER.phase("startup: builtins"):
+                self.read_commands(shellstate, InputReader("shell", iter(builtin_script.split("\n"))))
 
             if self.debug:
                 print("End of builtins...")
 
         if load_init and not parent:
             try:
-                shell_init = open(os.path.expanduser("~/.demoshrc"), "r")
+                shell_init_path = os.path.expanduser("~/.demoshrc")
+                shell_init = open(shell_init_path, "r")
 
                 if self.debug:
                     print("Loading ~/.demoshrc...")
 
-                self.read_commands(shellstate, InputReader("shell", shell_init))
+                with PROFILER.phase("startup: ~/.demoshrc"):
+                    self.read_commands(shellstate, InputReader("shell", shell_init, path=shell_init_path))
 
                 if self.debug:
                     print("End of ~/.demoshrc...")
@@ -128,61 +199,165 @@ class DemoState:
                 pass
 
             try:
-                md_init = open(os.path.expanduser("~/.demoshrc.md"), "r")
+                md_init_path = os.path.expanduser("~/.demoshrc.md")
+                md_init = open(md_init_path, "r")
 
                 if self.debug:
                     print("Loading ~/.demoshrc.md...")
 
-                self.read_commands(shellstate, InputReader("markdown", md_init))
+                with PROFILER.phase("startup: ~/.demoshrc.md"):
+                    self.read_commands(shellstate, InputReader("markdown", md_init, path=md_init_path))
 
                 if self.debug:
                     print("End of ~/.demoshrc.md...")
             except FileNotFoundError:
                 pass
 
-        self.read_commands(shellstate, InputReader(self.mode, script))
+        # In lazy mode, we don't read the script itself until run needs it,
+        # so we can start running before we've seen all of it (which also
+        # means that we can read it from a pipe).
+        self.lazy = bool(lazy)
+        reader = InputReader(self.mode, script, path=path)
+
+        if not self.lazy:
+            with PROFILER.phase("startup: script" if not parent else "startup: macro bodies"):
+                self.read_commands(shellstate, reader)
+
+        # Lower everything we read into instructions for run.
+        self._compiler = Compiler()
+
+        with PROFILER.phase("startup: compile"):
+            self.instructions: List[Instruction] = self._compiler.compile_all(self.commands)
+
+        self.cmd_index = 0
+
+        self._pending: Optional[Iterator[Command]] = None
+
+        if self.lazy:
+            self._pending = self.parse_commands(shellstate, reader, cache=False)
+
+        self._dispatch = {
+            "blank": self.do_blank,
+            "display": self.do_display,
+            "typeout": self.do_typeout,
+            "setflag": self.do_setflag,
+            "ifhook": self.do_ifhook,
+            "exec": self.do_exec,
+            "label": self.do_label,
+            "parallel": self.do_parallel,
+            "invalid": self.do_invalid,
+        }
+
+        if (self.parse_cache is not None) and not parent:
+            if self.debug:
+                print(f"Parse cache: {self.parse_cache.hits} hits, {self.parse_cache.misses} misses")
+
+            self.parse_cache.save()
 
     def read_commands(self, shellstate: 'ShellState', reader: Optional[InputReader]) -> None:
         if reader is None:
             reader = self.reader
 
-        for rawcmd in reader.read_element():
+        self.commands.extend(self.parse_commands(shellstate, reader))
+
+    def read_all(self) -> None:
+        # Finish reading everything a lazy DemoState hasn't read yet.
+        while self.instruction(len(self.instructions)) is not None:
+            pass
+
+    def instruction(self, idx: int) -> Optional[Instruction]:
+        # Return instruction idx, reading more of the script if we have to
+        # (and can), or None if there's no such instruction.
+        while (idx >= len(self.instructions)) and (self._pending is not None):
+            cmd = next(self._pending, None)
+
+            if cmd is None:
+                self._pending = None
+                break
+
+            self.commands.append(cmd)
+            instr = self._compiler.compile(cmd)
+
+            if instr is not None:
+                self.instructions.append(instr)
+                self.start_prefetch(len(self.instructions) - 1)
+
+        if idx < len(self.instructions):
+            return self.instructions[idx]
+
+        return None
+
+    def start_prefetch(self, idx: int) -> None:
+        # #@prefetch starts its command as soon as we've read it and know
+        # that we'll get to it. This only works at the top level: a macro
+        # (say) could run any number of times, or none, so in there,
+        # #@prefetch does nothing.
+        if (not self.prefetching) or (self._prefetch_from is None) or (idx < self._prefetch_from):
+            return
+
+        instr = self.instructions[idx]
+
+        if instr.op == "exec":
+            assert instr.cmd is not None    # hush, mypy
+
+            if instr.cmd.prefetch:
+                self.shellstate.prefetch(instr.cmd)
+
+    def parse_commands(self, shellstate: 'ShellState', reader: InputReader,
+                       cache: bool=True) -> Iterator[Command]:
+        # Parse Commands from reader, handling imports, hooks, and macros
+        # as we go. This is a generator so that lazy mode can parse only
+        # as far as it needs to.
+        elements: Iterable[Union[RawSingleValue, RawMultiValue]]
+
+        if cache and (self.parse_cache is not None):
+            elements = self.parse_cache.read(reader)
+        else:
+            elements = reader.read_element()
+
+        yield from self.parse_elements(shellstate, elements, reader.path)
+
+    def parse_elements(self, shellstate: 'ShellState',
+                       elements: Iterable[Union[RawSingleValue, RawMultiValue]],
+                       path: Optional[str]) -> Iterator[Command]:
+        # path is the file the elements came from, if any.
+        for rawcmd in elements:
             if self.debug:
                 print(f"{self._level}: CMD {rawcmd}")
 
             if rawcmd.type == "cmd":
                 assert isinstance(rawcmd, RawSingleValue)
                 cmd = Command(rawcmd.value)
-                self.commands.append(cmd)
+                yield cmd
 
             elif rawcmd.type == "comment":
                 assert isinstance(rawcmd, RawSingleValue)
                 cmd = Command(rawcmd.value, comment=True, markdown=(rawcmd.name == "markdown"))
-                self.commands.append(cmd)
+                yield cmd
 
             elif rawcmd.type == "import":
                 assert isinstance(rawcmd, RawSingleValue)
 
-                imode = "shell"
+                ipath = self.imports.resolve(rawcmd.value, path)
 
-                if rawcmd.value.lower().endswith(".md"):
-                    imode = "markdown"
-
-                ireader = InputReader(imode, open(rawcmd.value, "r"))
-                self.read_commands(shellstate, ireader)
+                with self.imports.importing(ipath) as first:
+                    if first:
+                        ielements = self.imports.elements(ipath, self.parse_cache)
+                        yield from self.parse_elements(shellstate, ielements, ipath)
 
             elif rawcmd.type == "hook":
                 assert isinstance(rawcmd, RawSingleValue)
                 varname = f"DEMO_HOOK_{rawcmd.value}"
 
                 value = self.shellstate.env.get(varname, None)
+                shellstate.hook_names.add(rawcmd.name)
 
                 if value:
                     self.shellstate._hooks.add(rawcmd.name)
                 else:
                     value = ":;"
 
-                shellstate.functions.append("\n".join([
+                shellstate.prelude.define(rawcmd.name, "\n".join([
                     "%s() {" % rawcmd.name,
                     value,
                     "}"
@@ -193,7 +368,8 @@ class DemoState:
                     print(f"{self._level}: processing macro {rawcmd.name}")
 
                 assert isinstance(rawcmd, RawMultiValue)
-                macro_ds = DemoState(self.shellstate, "shell", iter(rawcmd.value), parent=self)
+                with PROFILER.phase("startup: macros"):
+                    macro_ds = DemoState(self.shellstate, "shell", iter(rawcmd.value), parent=self, path=path)
 
                 if self.debug:
                     print(f"{self._level}: saving DemoState for macro {rawcmd.name}")
@@ -205,65 +381,25 @@ class DemoState:
                     print(f"{self._level}: processing ifhook {rawcmd.name}")
 
                 assert isinstance(rawcmd, RawMultiValue)
-                ifhook_ds = DemoState(self.shellstate, "shell", iter(rawcmd.value), parent=self)
+                ifhook_ds = DemoState(self.shellstate, "shell", iter(rawcmd.value), parent=self, path=path)
 
                 if self.debug:
                     print(f"{self._level}: pushing DemoState for ifhook {rawcmd.name}")
 
                 cmd = Command(rawcmd.name, conditional="ifhook", demostate=ifhook_ds)
-                self.commands.append(cmd)
-
-    def handlemeta(self, cmd: Command) -> bool:
-        # Make mypy shut up
-        assert (len(cmd.cmdline) > 2) and (cmd.cmdline[0] == "#")
-
-        cs = cmd.cmdline[2:].strip()
-
-        if cs == "SKIP":
-            self.skipping = True
-            return True
-        elif cs == "SHOW":
-            self.showing = True
-            return True
-        elif cs == "HIDE":
-            self.showing = False
-            return True
-        elif cs in DemoState.Standalones:
-            # This is a standalone command, not a modifier for the next command.
-            self._overrides['wait_before'] = False
-            self._overrides['wait_after'] = True
-            self._overrides['type_command'] = False
-            return False
-        elif cs == "wait":
-            # This is a standalone command, not a modifier for the next command.
-            self._overrides['wait_before'] = False
-            self._overrides['wait_after'] = True
-            self._overrides['type_command'] = False
-            self._overrides['explicit_wait'] = True
-            return False
-        elif cs == "waitafter":
-            self._overrides['wait_after'] = True
-            return True
-        elif cs == "nowaitbefore":
-            self._overrides['wait_before'] = False
-            return True
-        elif cs == "noshow":
-            self._overrides['type_command'] = False
-            return True
-        elif cs == "notypeout":
-            self._overrides['typeout'] = False
-            return True
-        else:
-            self._overrides['wait_before'] = False
-            self._overrides['wait_after'] = False
-            self._overrides['type_command'] = False
+                yield cmd
 
-            if (cs == "immed") or (cs == "immediate"):
-                return True
+            elif rawcmd.type == "parallel":
+                assert isinstance(rawcmd, RawMultiValue)
+                parallel_ds = DemoState(self.shellstate, "shell", iter(rawcmd.value), parent=self, path=path)
 
-        return False
+                cmd = Command("parallel", conditional="parallel", demostate=parallel_ds)
+                yield cmd
 
     def start_color(self, color: int) -> str:
+        if not self.use_color:
+            return ""
+
         cstr = self._colors.get(str(color), None)
 
         if not cstr:
@@ -278,6 +414,9 @@ class DemoState:
         return cstr
 
     def end_color(self) -> str:
+        if not self.use_color:
+            return ""
+
         if self._end_color is None:
             sgr0 = curses.tigetstr("sgr0")
             decoded = ""
@@ -290,6 +429,9 @@ class DemoState:
         return self._end_color
 
     def get_cap(self, capname: str) -> str:
+        if not self.use_color:
+            return ""
+
         cstr = self._colors.get(capname, None)
 
         if cstr is None:
@@ -326,164 +468,15 @@ class DemoState:
 
         return ""
 
+    @profiled("run: markdownify")
     def markdownify(self, text: str) -> str:
-        states = [ "LineStart" ]
-        dchars = { "`", "_" }
-        colors: List[str] = []
-        decorations: List[str] = []
-
-        output = ""
-        hc = 0
-
-        idx = 0
-
-        while idx < len(text):
-            c = text[idx]
-            idx += 1
-
-            state = states[-1]
-
-            if state == "LineStart":
-                if c == '#':
-                    # Header!
-                    hc = 1
-                    states.append("Header")
-                else:
-                    if not colors:
-                        cstr = self.start_color(1)
-                        colors.append(cstr)
-                        output += cstr
-
-                    states.append("Normal")
-                    idx -= 1
-
-            elif state == "Header":
-                if c == '#':
-                    hc += 1
-                else:
-                    if hc == 1:
-                        output += self.start_bold()
-
-                    cstr = self.start_color(2)
-                    colors.append(cstr)
-                    output += cstr
-                    output += self.start_underline()
-                    output += '#' * hc
-                    idx -= 1
-                    states.append("Normal")
-
-            elif state == "Normal":
-                if c == "\n":
-                    states.pop()
-
-                    if states[-1] == "Header":
-                        output += self.end_underline()
-                        output += self.end_bold()
-                        output += self.end_color()
-                        colors = []
-
-                        states.pop()
-                        assert states[-1] == "LineStart", "Popped Header and didn't get LineStart?"
-
-                elif c == "*":
-                    # Asterisk is weird because "**" and "*" are both valid
-                    # decorations, and because "*" can also mark a list item.
-                    states.append("Asterisk")
-                    continue
-
-                elif c == "`":
-                    # It's important to realize that we'll never have "```" at this point
-                    # (it will have become a command) and also that we don't want to do
-                    # formatting inside backticks. So switch to a new state.
-
-                    states.append("Backtick")
-
-                    # Switch to color 4.
-                    cstr = self.start_color(4)
-                    colors.append(cstr)
-                    output += cstr
-
-                    continue
-
-                elif c in dchars:
-                    # XXX Kind of leftover code: the only decoration we can see here is
-                    # an underscore, so this can probably be simplified now.
-                    if decorations and (c == decorations[-1]):
-                        decorations.pop()
-                        colors.pop()
-                        output += colors[-1]
-                        continue
-                    else:
-                        color = 5
-
-                        if c == '`':
-                            color = 4
-                        elif c == '_':
-                            color = 4
-
-                        cstr = self.start_color(color)
-                        colors.append(cstr)
-                        output += cstr
-
-                        decorations.append(c)
-                        continue
-
-                output += c
-
-            elif state == "Asterisk":
-                # We're not going to stay in the Asterisk
-                # state no matter what.
-                states.pop()
-
-                if c == '*':
-                    # Two asterisks is its very own kind of decoration.
-                    if decorations and ("**" == decorations[-1]):
-                        decorations.pop()
-                        colors.pop()
-                        output += colors[-1]
-                        continue
-
-                    cstr = self.start_color(5)
-                    colors.append(cstr)
-                    output += cstr
-                    decorations.append("**")
-                elif (decorations and ("*" == decorations[-1])):
-                    # This is the end of a single asterisk decoration.
-                    decorations.pop()
-                    colors.pop()
-                    output += colors[-1] + c
-                    continue
-                elif not (c.isalnum() or (c == "\n")):
-                    # This is just a plain old asterisk, not the start of
-                    # anything.
-                    output += "*" + c
-                else:
-                    # One asterisk is a decoration.
-                    if decorations and ("*" == decorations[-1]):
-                        decorations.pop()
-                        colors.pop()
-                        output += colors[-1]
-                        continue
-
-                    cstr = self.start_color(5)
-                    colors.append(cstr)
-                    output += cstr + c
-                    decorations.append("*")
-
-            elif state == "Backtick":
-                if c == "`":
-                    # Done with backticks!
-                    states.pop()
-                    colors.pop()
-                    output += colors[-1]
-                    continue
-
-                output += c
+        caps = (self.start_color(1), self.start_color(2), self.start_color(4), self.start_color(5),
+                self.start_bold(), self.end_bold(), self.start_underline(), self.end_underline(),
+                self.end_color())
 
-        output += self.end_color()
-
-        return output
+        return markdown.renderer(caps).render(text)
 
+    @profiled("run: display")
     def display(self, text: str, newline: bool=True, force: bool=False, markdown: bool=False) -> None:
         if self.showing or force:
             if text == "":
@@ -504,9 +497,19 @@ class DemoState:
 
             self.echo_blanks = not (text == "")
 
+    @profiled("run: typeout")
     def display_slowly(self, prefix: str, text: str, suffix: str, strip_leading_comments: bool=True) -> Optional[str]:
         ch = ""
 
+        if self.batch:
+            # No typing things out in batch mode.
+            if strip_leading_comments:
+                text = text.replace("\n#", "\n")
+
+            sys.stdout.write(self.color(prefix) + prefix + text + suffix + self.end_color())
+            sys.stdout.flush()
+            return None
+
         sys.stdout.write(self.color(prefix))
         sys.stdout.write(prefix)
         sys.stdout.flush()
@@ -517,23 +520,11 @@ class DemoState:
         try:
             self.raw()
 
-            for i in range(len(text)):
-                sys.stdout.write(text[i])
-                sys.stdout.flush()
-
-                # We're using select() here both to check for early input
-                # _and_ for the intercharacter delay.
-                keypressed, _, _ = select.select([self.fd], [], [], chardelay())
-
-                if keypressed:
-                    # Early input! Read it and rush to the end of the command.
-                    ch = os.read(self.fd, 1).decode('utf-8')
+            ch, written = self.typeout.type(text, self.terminal, set(self._action_chars.keys()))
 
-                    if ch in self._action_chars:
-                        if self._action_chars[ch] != "quit":
-                            if i < len(text):
-                                sys.stdout.write(text[i+1:])
-                        break
+            if ch and (self._action_chars[ch] != "quit"):
+                # Early input! Rush to the end of the command.
+                sys.stdout.write(text[written:])
 
             if suffix:
                 sys.stdout.write(suffix)
@@ -541,204 +532,375 @@ class DemoState:
         finally:
             sys.stdout.write(self.end_color())
             sys.stdout.flush()
-            self.sane()
 
         action = self._action_chars.get(ch, None)
         # print(f"DS returning {action}")
         return action
 
-    def setup_termios(self) -> None:
-        LFLAG = 3
-        CC = 6
-
-        self._sane = termios.tcgetattr(self.fd)
-
-        self._cbreak = termios.tcgetattr(self.fd)
-        self._cbreak[LFLAG] = self._cbreak[LFLAG] & ~termios.ICANON & ~termios.ECHO
-
-        self._raw = termios.tcgetattr(self.fd)
-        self._raw[LFLAG] = self._raw[LFLAG] & ~termios.ICANON & ~termios.ECHO
-        self._raw[CC][termios.VMIN] = 0
-        self._raw[CC][termios.VTIME] = 0
+    # The terminal stays in raw mode while we're typing and waiting, and
+    # only goes back to sane mode when something else needs it.
 
     def sane(self) -> None:
-        if self._sane:
-            termios.tcsetattr(self.fd, termios.TCSADRAIN, self._sane)
+        self.terminal.sane()
 
     def cbreak(self) -> None:
-        if self._cbreak:
-            termios.tcsetattr(self.fd, termios.TCSADRAIN, self._cbreak)
+        self.terminal.cbreak()
 
     def raw(self) -> None:
-        if self._raw:
-            termios.tcsetattr(self.fd, termios.TCSADRAIN, self._raw)
+        self.terminal.raw()
 
     def find_previous_command(self, delta: int) -> Optional[int]:
         idx = self.cmd_index - delta
 
         while idx >= 0:
-            cmd = self.commands[idx]
+            instr = self.instructions[idx]
 
-            if not cmd.ishidden() and not cmd.iscomment() and not cmd.isblank():
-                # print(f"-landed on {idx}: {cmd}")
+            if instr.repeatable and not instr.hidden:
+                # print(f"-landed on {idx}: {instr}")
                 return idx
 
-            # print(f"-continue past on {idx}: {cmd}")
+            # print(f"-continue past on {idx}: {instr}")
             idx -= 1
 
         return None
 
+    def find_start(self, target: str) -> Optional[int]:
+        # Find where --start-at should start: a step number (counting only
+        # real commands, from 1), an #@label, or a Markdown heading.
+        self.read_all()
+
+        if target.isdigit():
+            step = 0
+
+            for idx, instr in enumerate(self.instructions):
+                if instr.repeatable:
+                    step += 1
+
+                    if step == int(target):
+                        return idx
+
+            return None
+
+        for idx, instr in enumerate(self.instructions):
+            if (instr.op == "label") and (instr.text == target):
+                return idx
+
+        heading = target.strip().lower()
+
+        for idx, instr in enumerate(self.instructions):
+            if (instr.op == "display") and instr.cmd and instr.cmd.markdown:
+                for line in instr.cmd.cmdline.split("\n"):
+                    m = reHeading.match(line)
+
+                    if m and (m.group(1).lower() == heading):
+                        return idx
+
+        return None
+
+    def start_at(self, target: str) -> bool:
+        # Get ready to start running at target, by replaying everything
+        # before it that changes the ShellState. Returns False if we can't.
+        idx = self.find_start(target)
+
+        if idx is None:
+            print(f"{self.start_color(5)}...can't find {target} to start at{self.end_color()}")
+            return False
+
+        if not self.replay(idx):
+            return False
+
+        self.shellstate.resume = [ { "index": idx, "showing": self.showing } ]
+        return True
+
+    def replay(self, end: int) -> bool:
+        # Run only the state-changing commands in the first end instructions
+        # (and in any macros or hooks they run), without displaying, typing,
+        # or waiting for anything. Returns False if we have to stop.
+        for instr in self.instructions[:end]:
+            if instr.op == "setflag":
+                setattr(self, instr.flag, instr.value)
+
+            elif instr.op == "ifhook":
+                assert instr.cmd is not None    # hush, mypy
+
+                if instr.cmd.cmdline in self.shellstate._hooks:
+                    assert isinstance(instr.cmd.demostate, DemoState)
+                    child = instr.cmd.demostate
+
+                    if not child.replay(len(child.instructions)):
+                        return False
+
+            elif instr.op == "exec":
+                assert instr.cmd is not None    # hush, mypy
+
+                if not self.replay_command(instr.cmd):
+                    return False
+
+        return True
+
+    def replay_command(self, cmd: Command) -> bool:
+        cmdline = cmd.cmdline
+
+        if cmd.ismeta():
+            cmdline = cmdline[2:]
+
+        if not cmd.setup:
+            if not (reAssignment.match(cmdline) or reFunction.match(cmdline)):
+                first = cmdline.split(None, 1)[0] if cmdline.strip() else ""
+
+                if first in self.shellstate.macros:
+                    macro = self.shellstate.macros[first]
+                    return macro.replay(len(macro.instructions))
+
+                if first not in ("cd", "set"):
+                    return True
+
+        if self.debug:
+            print(f"replaying: {cmdline.rstrip()}")
+
+        rc = self.shellstate.run(self, cmd)
+
+        if rc != 0:
+            self.shellstate.failures += 1
+
+            if self.shellstate.exit_on_failure:
+                print(f"{self.start_color(5)}...exiting due to failure.{self.end_color()}")
+                self.shellstate.stopping = True
+                return False
+
+        return True
+
     def run(self) -> None:
         self.cmd_index = 0
+        resuming = False
+
+        if self.shellstate.resume:
+            # Pick up where a checkpoint left off.
+            level = self.shellstate.resume.pop(0)
+            self.cmd_index = level["index"]
+            self.showing = level["showing"]
+
+            if self.shellstate.resume:
+                # We were partway through whatever this instruction runs (a
+                # macro or an #@ifhook), so run it again, without showing
+                # the command again, to get back there.
+                resuming = True
+                self._overrides = {
+                    "type_command": False,
+                    "wait_before": False,
+                }
+
+        if self.prefetching and (self._prefetch_from is None):
+            # Now we know where we're starting, so start prefetching
+            # everything from here on that we've already read.
+            self._prefetch_from = self.cmd_index
+
+            for idx in range(self.cmd_index, len(self.instructions)):
+                self.start_prefetch(idx)
 
+        if self.checkpoint is not None:
+            self.checkpoint.enter(self)
+
+        try:
+            self.run_instructions(resuming)
+        finally:
+            if self.checkpoint is not None:
+                self.checkpoint.leave()
+
+    def run_instructions(self, resuming: bool) -> None:
         while True:
-            if self.cmd_index >= len(self.commands):
-                break
+            instr = self.instruction(self.cmd_index)
 
-            cmd = self.commands[self.cmd_index]
+            if instr is None:
+                break
 
             if not self.showing:
-                cmd.hidden = True
+                instr.hidden = True
 
             if self.debug:
-                print(f"--{self.skipping and '#' or '-'} {self.cmd_index}: {cmd}")
+                print(f"--- {self.cmd_index}: {instr}")
 
             self.cmd_index += 1
 
-            if self.skipping:
-                if cmd.cmdline.strip() == "#@SHOW":
-                    self.skipping = False
-                else:
-                    continue
+            keep_going = self._dispatch[instr.op](instr)
 
-            if cmd.isblank():
-                self.display("")
-                continue
+            if resuming:
+                # Whatever's left of the resume stack didn't get used (the
+                # script must have changed), so forget it.
+                self.shellstate.resume = []
+                resuming = False
 
-            if cmd.iscomment():
-                if cmd.ishiddencomment():
-                    continue
+                if instr.op != "exec":
+                    self._overrides = {}
 
-                show = True
+            if not keep_going or self.shellstate.stopping:
+                break
 
-                if cmd.ismeta():
-                    show = False
+            if (self.checkpoint is not None) and (instr.op in ("exec", "parallel", "setflag")):
+                self.checkpoint.save(self.shellstate)
 
-                    if self.handlemeta(cmd):
-                        continue
+    # Instruction handlers. Each of these returns True to keep running, or
+    # False to stop.
 
-                if show:
-                    if cmd.cmdline.startswith("#$"):
-                        self.display_slowly("$ ", cmd.cmdline[2:].strip(), "\n")
-                    else:
-                        self.display(self.shellstate.expand_env(cmd.cmdline.rstrip()),
-                                     markdown=bool(cmd.markdown))
-                    continue
+    def do_blank(self, instr: Instruction) -> bool:
+        self.display("")
+        return True
 
-            if cmd.isconditional():
-                if cmd.conditional == "ifhook":
-                    if self.debug:
-                        ispresent = '' if (cmd.cmdline in self.shellstate._hooks) else ' not'
-                        print(f"Hook {cmd.cmdline}{ispresent} present")
+    def do_display(self, instr: Instruction) -> bool:
+        assert instr.cmd is not None    # hush, mypy
 
-                    if cmd.cmdline in self.shellstate._hooks:
-                        assert isinstance(cmd.demostate, DemoState)
-                        cmd.demostate.run()
-                else:
-                    print(f"Invalid conditional type {cmd.conditional}")
+        self.display(self.shellstate.expand_env(instr.cmd.cmdline.rstrip()),
+                     markdown=bool(instr.cmd.markdown))
+        return True
 
-                continue
+    def do_typeout(self, instr: Instruction) -> bool:
+        self.display_slowly("$ ", instr.text, "\n")
+        return True
 
-            # If we're here, it's meant to be executed. First, apply overrides.
-            cmd = cmd.copy()
+    def do_setflag(self, instr: Instruction) -> bool:
+        setattr(self, instr.flag, instr.value)
+        return True
 
-            for k, v in self._overrides.items():
-                setattr(cmd, k, v)
+    def do_ifhook(self, instr: Instruction) -> bool:
+        cmd = instr.cmd
+        assert cmd is not None          # hush, mypy
 
-            # Clear the overrides.
-            self._overrides = {}
+        if self.debug:
+            ispresent = '' if (cmd.cmdline in self.shellstate._hooks) else ' not'
+            print(f"Hook {cmd.cmdline}{ispresent} present")
 
-            if self.debug:
-                print(f"--> {self.cmd_index}: {cmd}")
-
-            action = None
-            typeout = cmd.typeout
-
-            while True:
-                if self.showing:
-                    if cmd.type_command:
-                        text = self.shellstate.expand_env(cmd.cmdline.rstrip())
-
-                        if typeout:
-                            action = self.display_slowly("$ ", text, "" if cmd.wait_before else "\n")
-                        else:
-                            self.display("$ " + text, newline=False)
-                            action = None
-
-                        if not action or (action == "fast-forward"):
-                            if cmd.wait_before:
-                                action = self.wait_to_proceed()
-
-                        if cmd.wait_before or (not typeout):
-                            sys.stdout.write("\n")
-                            sys.stdout.flush()
-                elif cmd.explicit_wait:
-                    # The #@wait command _always_ executes, showing or not.
-                    action = self.wait_to_proceed()
-
-                if action == "repeat":
-                    # We _don't_ want to execute this command; we want the previous
-                    # command.
-                    prev_idx = self.find_previous_command(2)
-
-                    if prev_idx is None:
-                        print(f"{self.start_color(5)}...nothing earlier to repeat!{self.end_color()}")
-                        typeout = False
-                        continue
-
-                    # Found something good here.
-                    self.cmd_index = prev_idx
-                    self._overrides = {
-                        "type_command": True,
-                        "typeout": False,
-                        "wait_before": True,
-                    }
-
-                # Not repeat, so we're finished repeating.
-                break
+        if cmd.cmdline in self.shellstate._hooks:
+            assert isinstance(cmd.demostate, DemoState)
+            cmd.demostate.run()
 
-            if action == "repeat":
-                continue
+        return True
 
-            self.echo_blanks = True
+    def do_parallel(self, instr: Instruction) -> bool:
+        assert instr.cmd is not None    # hush, mypy
+        assert isinstance(instr.cmd.demostate, DemoState)
 
-            if (not action or
-                ((action != "subshell") and (action != "skip") and (action != "quit"))):
-                rc = self.shellstate.run(self, cmd)
+        block = instr.cmd.demostate
+        block.read_all()
 
-                if (rc != 0) and self.shellstate.exit_on_failure:
-                    print(f"{self.start_color(5)}...exiting due to failure.{self.end_color()}")
-                    break
+        cmdlines: List[str] = []
+
+        for binstr in block.instructions:
+            if binstr.op == "exec":
+                assert binstr.cmd is not None    # hush, mypy
+                cmdline = binstr.cmd.cmdline
 
-                if self.showing and cmd.wait_after:
-                    action = self.wait_to_proceed()
+                if binstr.cmd.ismeta():
+                    cmdline = cmdline[2:]
 
-            if action == "subshell":
-                # Repeat this same command when back from the subshell.
-                self.cmd_index -= 1
-                self.shellstate.subshell(self)
-                continue
+                cmdlines.append(cmdline.rstrip())
+
+        if not cmdlines:
+            return True
+
+        if self.showing:
+            for i, cmdline in enumerate(cmdlines):
+                self.display(f"[{i + 1}] $ {self.shellstate.expand_env(cmdline)}")
+
+            action = self.wait_to_proceed()
+
+            if action == "quit":
+                self.shellstate.stopping = True
+                return False
 
             if action == "skip":
                 print(f"{self.start_color(5)}...skipping{self.end_color()}")
+                return True
 
-            if action == "quit":
-                break
+        self.echo_blanks = True
+        self.sane()
+
+        rcs = self.shellstate.run_parallel(cmdlines)
+        failed = [ i for i, rc in enumerate(rcs) if rc != 0 ]
+
+        if failed:
+            self.shellstate.failures += len(failed)
+
+            which = ", ".join(f"[{i + 1}]" for i in failed)
+            print(f"{self.start_color(5)}...{len(failed)} of {len(rcs)} parallel commands failed: {which}{self.end_color()}")
+
+            if self.shellstate.exit_on_failure:
+                print(f"{self.start_color(5)}...exiting due to failure.{self.end_color()}")
+                self.shellstate.stopping = True
+                return False
+
+        return True
+
+    def do_label(self, instr: Instruction) -> bool:
+        # Labels are just for --start-at.
+        return True
+
+    def do_invalid(self, instr: Instruction) -> bool:
+        assert instr.cmd is not None    # hush, mypy
+
+        print(f"Invalid conditional type {instr.cmd.conditional}")
+        return True
+
+    def do_exec(self, instr: Instruction) -> bool:
+        if self.tracer is None:
+            return self.exec_command(instr, None)
+
+        assert instr.cmd is not None    # hush, mypy
+        step = self.tracer.start(self._level, instr.cmd.cmdline.rstrip())
+
+        try:
+            return self.exec_command(instr, step)
+        finally:
+            self.tracer.finish(step)
+
+    def exec_command(self, instr: Instruction, step: Optional[Step]) -> bool:
+        cmd = instr.cmd
+        assert cmd is not None          # hush, mypy
+
+        # The compiler already applied this command's modifiers. The only
+        # overrides we can have here are from repeating, which start over
+        # from the original command.
+        if self._overrides:
+            assert instr.base is not None   # hush, mypy
+            cmd = instr.base.copy()
+
+            for k, v in self._overrides.items():
+                setattr(cmd, k, v)
+
+            # Clear the overrides.
+            self._overrides = {}
+
+        if self.debug:
+            print(f"--> {self.cmd_index}: {cmd}")
+
+        action = None
+        typeout = cmd.typeout
+
+        while True:
+            if self.showing:
+                if cmd.type_command:
+                    text = self.shellstate.expand_env(cmd.cmdline.rstrip())
+
+                    if typeout:
+                        action = self.display_slowly("$ ", text, "" if cmd.wait_before else "\n")
+                    else:
+                        self.display("$ " + text, newline=False)
+                        action = None
+
+                    if not action or (action == "fast-forward"):
+                        if cmd.wait_before:
+                            action = self.wait_to_proceed()
+
+                    if cmd.wait_before or (not typeout):
+                        sys.stdout.write("\n")
+                        sys.stdout.flush()
+            elif cmd.explicit_wait:
+                # The #@wait command _always_ executes, showing or not.
+                action = self.wait_to_proceed()
 
             if action == "repeat":
                 # We _don't_ want to execute this command; we want the previous
                 # command.
-                prev_idx = self.find_previous_command(1)
+                prev_idx = self.find_previous_command(2)
 
                 if prev_idx is None:
                     print(f"{self.start_color(5)}...nothing earlier to repeat!{self.end_color()}")
@@ -753,24 +915,90 @@ class DemoState:
                     "wait_before": True,
                 }
 
+            # Not repeat, so we're finished repeating.
+            break
+
+        if action == "repeat":
+            return True
+
+        self.echo_blanks = True
+
+        if (not action or
+            ((action != "subshell") and (action != "skip") and (action != "quit"))):
+            # The command might run a child process, which will want a sane
+            # terminal.
+            self.sane()
+
+            if step:
+                step.executing()
+
+            rc = self.shellstate.run(self, cmd)
+
+            if step:
+                step.executed(rc)
+
+            if rc != 0:
+                self.shellstate.failures += 1
+
+                if self.shellstate.exit_on_failure:
+                    print(f"{self.start_color(5)}...exiting due to failure.{self.end_color()}")
+                    self.shellstate.stopping = True
+                    return False
+
+            if self.showing and cmd.wait_after:
+                action = self.wait_to_proceed()
+
+        if action == "subshell":
+            # Repeat this same command when back from the subshell.
+            self.cmd_index -= 1
+            self.sane()
+            self.shellstate.subshell(self)
+            return True
+
+        if action == "skip":
+            print(f"{self.start_color(5)}...skipping{self.end_color()}")
+
+        if action == "quit":
+            self.shellstate.stopping = True
+            return False
+
+        if action == "repeat":
+            # We _don't_ want to execute this command; we want the previous
+            # command.
+            prev_idx = self.find_previous_command(1)
+
+            if prev_idx is None:
+                print(f"{self.start_color(5)}...nothing earlier to repeat!{self.end_color()}")
+                return True
+
+            # Found something good here.
+            self.cmd_index = prev_idx
+            self._overrides = {
+                "type_command": True,
+                "typeout": False,
+                "wait_before": True,
+            }
+
+        return True
+
+    @profiled("run: waiting")
     def wait_to_proceed(self) -> Optional[str]:
         # print("Waiting to proceed...")
 
+        if self.batch:
+            # Nobody to wait for.
+            return None
+
         ch = None
 
-        try:
-            self.cbreak()
+        self.raw()
 
-            while True:
-                ch = os.read(self.fd, 1).decode('utf-8')
+        while True:
+            ch = self.terminal.read_key()
 
-                if ch in self._action_chars:
-                    break
-        finally:
-            self.sane()
+            if (ch is None) or (ch in self._action_chars):
+                break
 
-        action = self._action_chars.get(ch, None)
+        action = self._action_chars.get(ch, None) if ch else None
         # print(f"WP returning {action}")
         return action
-
-
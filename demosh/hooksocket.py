@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+from typing import BinaryIO, Optional
+
+import socket
+import time
+
+from .profiler import PROFILER
+
+
+# A HookSocket sends hooks to a local control process over a Unix-domain
+# socket, instead of running a shell for each one. We connect once and keep
+# the connection open, so a hook costs one round trip rather than a fork and
+# exec (or several).
+#
+# The protocol is lines of UTF-8 text. For each hook, we send the hook's
+# command line (the hook name, then any arguments), and the other end sends
+# back a line with the hook's exit status as a decimal integer.
+#
+# If we can't connect, or the connection fails, call returns None and the
+# caller falls back to the hook's shell function.
+class HookSocket:
+    def __init__(self, path: str, timeout: float=2.0, debug: bool=False) -> None:
+        self.path = path
+        self.timeout = timeout
+        self.debug = debug
+
+        self._sock: Optional[socket.socket] = None
+        self._reader: Optional[BinaryIO] = None
+        self._failed = False
+
+        # Round-trip times, in seconds.
+        self.calls = 0
+        self.total_rtt = 0.0
+        self.max_rtt = 0.0
+
+    def connect(self) -> bool:
+        # Connect if we haven't already. Once connecting has failed, we don't
+        # keep trying: that would slow every hook down.
+        if self._sock is not None:
+            return True
+
+        if self._failed:
+            return False
+
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+        except OSError as e:
+            if self.debug:
+                print(f"Could not connect to hook socket {self.path}: {e}")
+
+            self._failed = True
+            return False
+
+        self._sock = sock
+        self._reader = sock.makefile("rb")
+        return True
+
+    def call(self, cmdline: str) -> Optional[int]:
+        # Run a hook, returning its exit status, or None if we couldn't.
+        if not self.connect():
+            return None
+
+        assert (self._sock is not None) and (self._reader is not None)   # hush, mypy
+
+        started = time.perf_counter()
+
+        try:
+            self._sock.sendall(cmdline.strip().replace("\n", " ").encode('utf-8') + b"\n")
+            reply = self._reader.readline()
+        except OSError as e:
+            reply = b""
+
+            if self.debug:
+                print(f"Hook socket {self.path} failed: {e}")
+
+        rtt = time.perf_counter() - started
+
+        try:
+            rc = int(reply.strip())
+        except ValueError:
+            # Whatever's on the other end isn't talking to us any more.
+            self.close()
+            self._failed = True
+            return None
+
+        self.calls += 1
+        self.total_rtt += rtt
+        self.max_rtt = max(self.max_rtt, rtt)
+
+        if PROFILER.enabled:
+            PROFILER.add("run: hook socket", rtt)
+
+        if self.debug:
+            print(f"hook {cmdline.strip()}: rc {rc} in {rtt * 1000:.2f} ms")
+
+        return rc
+
+    def close(self) -> None:
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def stats(self) -> str:
+        if not self.calls:
+            return f"hook socket {self.path}: no calls"
+
+        mean = self.total_rtt / self.calls
+        return (f"hook socket {self.path}: {self.calls} calls, "
+                f"mean RTT {mean * 1000:.2f} ms, max {self.max_rtt * 1000:.2f} ms")
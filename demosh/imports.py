@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union, TYPE_CHECKING
+
+import contextlib
+import os
+
+from .command import InputReader, RawSingleValue, RawMultiValue
+
+if TYPE_CHECKING:
+    from .parsecache import ParseCache
+
+
+RawElement = Union[RawSingleValue, RawMultiValue]
+
+
+class ImportCycleError(Exception):
+    pass
+
+
+# Parsed imports, by real path, along with the mtime and size they had when
+# we parsed them. This is shared by every ImportResolver in the process.
+_parsed: Dict[str, Tuple[int, int, List[RawElement]]] = {}
+
+
+# An ImportResolver handles #@import for a whole run: it works out which
+# file an import means, makes sure that each file gets imported only once
+# (so a library that several files import only gets parsed once, and only
+# defines its hooks and macros once), and catches files that import each
+# other in a cycle.
+class ImportResolver:
+    def __init__(self, debug: bool=False) -> None:
+        self.debug = debug
+
+        # Every file we've imported (or started to), and the ones we're in
+        # the middle of importing right now, outermost first.
+        self.seen: Set[str] = set()
+        self.stack: List[str] = []
+
+    def resolve(self, path: str, importer: Optional[str]) -> str:
+        # Relative paths are relative to the file doing the importing. For
+        # compatibility, if there's no such file there but there is one
+        # relative to the current directory, use that.
+        path = os.path.expanduser(path)
+
+        if not os.path.isabs(path) and importer:
+            candidate = os.path.join(os.path.dirname(os.path.abspath(importer)), path)
+
+            if os.path.exists(candidate) or not os.path.exists(path):
+                path = candidate
+
+        return os.path.realpath(path)
+
+    def root(self, path: str) -> None:
+        # The top-level script counts as imported, so that importing it
+        # again is a cycle.
+        realpath = os.path.realpath(path)
+
+        self.seen.add(realpath)
+        self.stack.append(realpath)
+
+    @contextlib.contextmanager
+    def importing(self, path: str) -> Iterator[bool]:
+        # Use as "with resolver.importing(path) as first:"; first is False if
+        # path was already imported and should be skipped. Raises
+        # ImportCycleError if path is already being imported.
+        if path in self.stack:
+            cycle = self.stack[self.stack.index(path):] + [ path ]
+            raise ImportCycleError("import cycle: " + " -> ".join(cycle))
+
+        if path in self.seen:
+            if self.debug:
+                print(f"already imported {path}")
+
+            yield False
+            return
+
+        self.seen.add(path)
+        self.stack.append(path)
+
+        try:
+            yield True
+        finally:
+            self.stack.pop()
+
+    def elements(self, path: str, parse_cache: Optional['ParseCache']=None) -> List[RawElement]:
+        # Return the raw elements of path, parsing it only if it's changed
+        # since we last did.
+        st = os.stat(path)
+        cached = _parsed.get(path, None)
+
+        if (cached is not None) and (cached[0] == st.st_mtime_ns) and (cached[1] == st.st_size):
+            return cached[2]
+
+        mode = "markdown" if path.lower().endswith(".md") else "shell"
+
+        with open(path, "r") as f:
+            reader = InputReader(mode, f, path=path)
+
+            if parse_cache is not None:
+                elements = parse_cache.read(reader)
+            else:
+                elements = list(reader.read_element())
+
+        _parsed[path] = (st.st_mtime_ns, st.st_size, elements)
+        return elements
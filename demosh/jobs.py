@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+from typing import IO, Optional
+
+import sys
+
+import subprocess
+import time
+
+
+# A Job is a command running in the background, started by #@background,
+# #@prefetch, or #@parallel. Its output (stdout and stderr both) goes to a
+# temporary file, so that it doesn't land on top of whatever the demo is
+# doing in the meantime; it gets shown when someone waits for the job.
+class Job:
+    def __init__(self, name: str, cmd: str, proc: subprocess.Popen, output: IO[bytes]) -> None:
+        self.name = name
+        self.cmd = cmd
+        self.proc = proc
+        self.output = output
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+
+    def done(self) -> bool:
+        if self.proc.poll() is None:
+            return False
+
+        if self.finished is None:
+            self.finished = time.monotonic()
+
+        return True
+
+    def wait(self) -> int:
+        self.proc.wait()
+        self.done()
+
+        return self.proc.returncode
+
+    def stop(self) -> None:
+        if not self.done():
+            self.proc.terminate()
+
+            try:
+                self.proc.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+
+        self.output.close()
+
+    def show(self, prefix: str="") -> None:
+        # Write out everything the job has said, then throw it away.
+        self.output.seek(0)
+
+        for line in self.output.read().decode('utf-8', errors='replace').splitlines():
+            sys.stdout.write(prefix + line + "\n")
+
+        sys.stdout.flush()
+        self.output.close()
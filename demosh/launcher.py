@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+from typing import Any
+
+import signal
+import subprocess
+
+
+# demosh itself has to survive ^C (and SIGTERM), but the commands it runs
+# shouldn't. The obvious way to do that is to ignore the signals in demosh,
+# then set them back to the default in each child with a preexec_fn -- but
+# any preexec_fn forces subprocess to fork the whole Python process and run
+# Python code in the child, instead of using vfork or posix_spawn, and that
+# gets slower the bigger demosh is.
+#
+# Instead, we _catch_ the signals with a handler that does nothing. That's
+# just as good as ignoring them as far as demosh is concerned, but exec
+# resets caught signals (unlike ignored ones) to their defaults, so children
+# get the default behavior without anyone having to do anything.
+
+def _ignore(signum: int, frame: Any) -> None:
+    # print(f"Ignoring signal {signum} in {os.getpid()}")
+    pass
+
+
+def ignore_signals() -> None:
+    signal.signal(signal.SIGINT, _ignore)
+    signal.signal(signal.SIGTERM, _ignore)
+
+
+def reset_signals() -> None:
+    # The slow way, for when someone has set things up so that the fast way
+    # won't work.
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def spawn(args: Any, **kwargs: Any) -> subprocess.Popen:
+    # Start a child process with SIGINT and SIGTERM at their defaults. All
+    # of demosh's child processes should be started through here; kwargs go
+    # straight to Popen.
+    if ((signal.getsignal(signal.SIGINT) == signal.SIG_IGN) or
+        (signal.getsignal(signal.SIGTERM) == signal.SIG_IGN)):
+        # Ignored signals stay ignored across exec, so we have to fix them
+        # up in the child.
+        kwargs["preexec_fn"] = reset_signals
+
+    return subprocess.Popen(args, **kwargs)
@@ -22,13 +22,32 @@
 # For more info, see README.md. If you've somehow found demosh without also
 # finding its repo, it's at github.com/BuoyantIO/demosh.
 
+from typing import Iterator, Optional
+
 import sys
 
 import argparse
+import os
+import stat
+import subprocess
+import time
+
+# Note when we started importing the rest of demosh, for --profile.
+_import_started = time.perf_counter()
 
 from . import __version__
 from .shellstate import ShellState
+from .checkpoint import Checkpoint
 from .demostate import DemoState
+from .imports import ImportCycleError
+from .parsecache import ParseCache
+from .profiler import PROFILER
+from .resultcache import ResultCache
+from .trace import Tracer
+from .transpile import Transpiler
+from .typeout import Typeout
+
+_import_finished = time.perf_counter()
 
 
 def main() -> None:
@@ -38,30 +57,181 @@ def main() -> None:
     parser.add_argument('--debug', action='store_true', help="enable debug output")
     parser.add_argument('--no-builtins', action='store_true', help="don't load builtin functions")
     parser.add_argument('--no-init', action='store_true', help="don't run ~/.demoshrc on startup")
+    parser.add_argument('--no-parse-cache', action='store_true', help="don't use or update the parsed-script cache")
+    parser.add_argument('--no-cache', action='store_true', help="ignore #@cache: always run commands for real")
+    parser.add_argument('--typeout-rate', type=float, default=None,
+                        help="average characters per second when typing commands out")
+    parser.add_argument('--typeout-seed', type=int, default=None,
+                        help="random seed for typeout delays, for repeatable timing")
+    parser.add_argument('--stream', action='store_true',
+                        help="start running the script before it's all been read (automatic for - and pipes)")
+    parser.add_argument('--markdown', action='store_true',
+                        help="read the script as Markdown even if its name doesn't end in .md")
+    parser.add_argument('--batch', action='store_true',
+                        help="run without a terminal: no waiting, no typeout, stop at the first failure")
+    parser.add_argument('--keep-going', action='store_true',
+                        help="in batch mode, keep going after failures (but still exit nonzero)")
+    parser.add_argument('--no-color', action='store_true', help="don't colorize output")
+    parser.add_argument('--trace', type=str, default=None, metavar='PREFIX',
+                        help="record timing for every step in PREFIX.jsonl and PREFIX.trace.json")
+    parser.add_argument('--profile', action='store_true',
+                        help="print a breakdown of where demosh spent its time on exit")
+    parser.add_argument('--profile-out', type=str, default=None, metavar='FILE',
+                        help="with --profile, also run cProfile and save its stats to FILE (e.g. demosh.prof)")
+    parser.add_argument('--persistent-shell', action='store_true',
+                        help="run commands in a single long-lived bash instead of a new shell per command")
+    parser.add_argument('--checkpoint', type=str, default=None, metavar='FILE',
+                        help="save a checkpoint to FILE after every step, for --resume")
+    parser.add_argument('--resume', type=str, default=None, metavar='FILE',
+                        help="restore the checkpoint in FILE and pick up where it left off")
+    parser.add_argument('--start-at', type=str, default=None, metavar='WHERE',
+                        help="start at a step number, #@label, or Markdown heading, replaying only setup before it")
+    parser.add_argument('--compile', type=str, default=None, metavar='OUT',
+                        help="don't run the script; write it to OUT as a standalone bash script (- for stdout)")
+    parser.add_argument('--compile-keep-print', action='store_true',
+                        help="with --compile, turn #@print into echo rather than dropping it")
 
-    parser.add_argument('script', type=str, help="script to run")
+    parser.add_argument('script', type=str, help="script to run (- for stdin)")
     parser.add_argument('args', type=str, nargs=argparse.REMAINDER, help="optional arguments to pass to script")
 
     args = parser.parse_args()
 
+    if args.profile or args.profile_out:
+        PROFILER.enable(cprofile=bool(args.profile_out))
+        PROFILER.add("startup: imports", _import_finished - _import_started)
+
     scriptname = args.script
     mode = "shell"
 
-    if scriptname.lower().endswith(".md"):
+    if args.markdown or scriptname.lower().endswith(".md"):
         mode = "markdown"
 
-    script = open(scriptname, "r")
+    lazy = args.stream
+    input_fd: Optional[int] = None
+    script: Iterator[str]
+
+    if scriptname == "-":
+        # Read the script from stdin, which means that keystrokes (and
+        # anything the commands themselves read) have to come from the
+        # terminal instead -- or from nowhere, in batch mode.
+        script = sys.stdin
+        lazy = True
+
+        if args.batch:
+            input_fd = subprocess.DEVNULL
+        else:
+            input_fd = os.open("/dev/tty", os.O_RDWR)
+    else:
+        script = open(scriptname, "r")
+
+        if stat.S_ISFIFO(os.fstat(script.fileno()).st_mode):
+            # Pipes get read as we go, too.
+            lazy = True
+
+    shellstate = ShellState(sys.argv[0], scriptname, args.args,
+                            persistent=args.persistent_shell)
+
+    if input_fd is not None:
+        shellstate.stdin = input_fd
+
+    if shellstate.hook_socket is not None:
+        shellstate.hook_socket.debug = args.debug
+
+    if not args.no_cache:
+        shellstate.result_cache = ResultCache(debug=args.debug)
+
+    if args.batch and not args.keep_going:
+        # Batch mode stops at the first failure, as if it had "set -e".
+        shellstate.exit_on_failure = True
+
+    tracer = None
+
+    if args.trace:
+        tracer = Tracer(args.trace)
+
+    checkpoint = None
+
+    if args.checkpoint or args.resume:
+        checkpoint = Checkpoint(args.checkpoint or args.resume, scriptname, debug=args.debug)
 
-    shellstate = ShellState(sys.argv[0], scriptname, args.args)
-    demostate = DemoState(shellstate, mode, script,
-                          debug=args.debug,
-                          load_builtins=not args.no_builtins,
-                          load_init=not args.no_init)
+    parse_cache = None
+
+    if not (args.no_parse_cache or (scriptname == "-")):
+        parse_cache = ParseCache(scriptname, debug=args.debug)
+
+    try:
+        demostate = DemoState(shellstate, mode, script,
+                              debug=args.debug,
+                              load_builtins=not args.no_builtins,
+                              load_init=not args.no_init,
+                              parse_cache=parse_cache,
+                              typeout=Typeout(rate=args.typeout_rate, seed=args.typeout_seed),
+                              lazy=lazy,
+                              input_fd=input_fd,
+                              batch=args.batch or bool(args.compile),
+                              color=not args.no_color,
+                              tracer=tracer,
+                              checkpoint=checkpoint,
+                              prefetch=not args.compile,
+                              path=None if (scriptname == "-") else scriptname)
+    except ImportCycleError as e:
+        shellstate.close()
+        sys.stderr.write(f"{scriptname}: {e}\n")
+        sys.exit(1)
+
+    if args.resume:
+        # Restore after reading the script, since reading it sets up hooks
+        # and functions that the checkpoint already has.
+        assert checkpoint is not None   # hush, mypy
+
+        if not checkpoint.restore(shellstate, args.resume):
+            sys.exit(1)
+
+        # The checkpoint only has the script's own "set -e", so apply the
+        # command line's policy on top of it again.
+        if args.batch and not args.keep_going:
+            shellstate.exit_on_failure = True
+
+    if args.compile:
+        output = Transpiler(keep_print=args.compile_keep_print).transpile(demostate)
+        shellstate.close()
+
+        if args.compile == "-":
+            sys.stdout.write(output)
+        else:
+            with open(args.compile, "w") as f:
+                f.write(output)
+
+            os.chmod(args.compile, 0o755)
+
+        return
 
     try:
+        if args.start_at and not demostate.start_at(args.start_at):
+            sys.exit(1)
+
         demostate.run()
+    except ImportCycleError as e:
+        sys.stderr.write(f"{scriptname}: {e}\n")
+        shellstate.failures += 1
     finally:
-        demostate.sane()
+        demostate.terminal.restore()
+        shellstate.close()
+
+        if tracer is not None:
+            tracer.close()
+
+        if PROFILER.enabled:
+            PROFILER.finish(args.profile_out)
+
+        if args.debug:
+            print(demostate.terminal.stats())
+
+            if shellstate.hook_socket is not None:
+                print(shellstate.hook_socket.stats())
+
+    if args.batch and shellstate.failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+from typing import Dict, List, Tuple
+
+import re
+
+
+# This is what the Markdown we care about looks like. Anything between
+# matches is plain text.
+reToken = re.compile(r"""
+    (?P<header>^\#+)                                    # header at start of line
+  | (?P<item>^[ \t]*(?:[-*+]|[0-9]+[.)])[ \t]+)         # list item marker
+  | (?P<code>`[^`]*`?)                                  # code span (maybe unclosed)
+  | (?P<link>\[[^\]\n]+\]\([^)\s]+\))                   # [text](url)
+  | (?P<strong>\*\*)                                    # strong
+  | (?P<star>\*)                                        # emphasis, or just an asterisk
+  | (?P<under>(?<![a-zA-Z0-9])_|_(?![a-zA-Z0-9]))       # underscore, not mid-word
+  | (?P<newline>\n)
+""", re.MULTILINE | re.VERBOSE)
+
+reLink = re.compile(r"\[([^\]\n]+)\]\(([^)\s]+)\)")
+
+
+# The terminal capabilities a renderer needs, in order: colors 1, 2, 4, and 5,
+# start and end bold, start and end underline, and reset.
+Caps = Tuple[str, str, str, str, str, str, str, str, str]
+
+
+# A MarkdownRenderer turns Markdown into text with terminal escapes, using a
+# given set of terminal capabilities. It tokenizes the text with one regex,
+# builds its output as a list, and remembers what it rendered, since the same
+# comments tend to get shown over and over (repeats, macros).
+class MarkdownRenderer:
+    # How many rendered texts to remember.
+    CacheSize = 256
+
+    def __init__(self, caps: Caps) -> None:
+        (self.c1, self.c2, self.c4, self.c5,
+         self.bold, self.end_bold, self.underline, self.end_underline,
+         self.reset) = caps
+
+        self._cache: Dict[str, str] = {}
+
+    def render(self, text: str) -> str:
+        output = self._cache.get(text, None)
+
+        if output is None:
+            output = self._render(text)
+
+            if len(self._cache) >= MarkdownRenderer.CacheSize:
+                # Forget the oldest thing we rendered.
+                del self._cache[next(iter(self._cache))]
+
+            self._cache[text] = output
+
+        return output
+
+    def _render(self, text: str) -> str:
+        output: List[str] = []
+        colors: List[str] = []
+        decorations: List[str] = []
+        in_header = False
+
+        def start_color(cstr: str) -> None:
+            colors.append(cstr)
+            output.append(cstr)
+
+        def end_color() -> None:
+            colors.pop()
+            output.append(colors[-1] if colors else self.reset)
+
+        def ensure_color() -> None:
+            # Ordinary text is color 1 unless something else is going on.
+            if not colors:
+                start_color(self.c1)
+
+        def toggle(decoration: str, cstr: str) -> None:
+            if decorations and (decorations[-1] == decoration):
+                decorations.pop()
+                end_color()
+            else:
+                decorations.append(decoration)
+                start_color(cstr)
+
+        idx = 0
+
+        for m in reToken.finditer(text):
+            if m.start() > idx:
+                ensure_color()
+                output.append(text[idx:m.start()])
+
+            idx = m.end()
+            kind = m.lastgroup
+            token = m.group(0)
+
+            if kind == "newline":
+                if in_header:
+                    output.append(self.end_underline)
+                    output.append(self.end_bold)
+                    output.append(self.reset)
+                    colors = []
+                    decorations = []
+                    in_header = False
+
+                output.append(token)
+
+            elif kind == "header":
+                if len(token) == 1:
+                    output.append(self.bold)
+
+                colors = []
+                decorations = []
+                start_color(self.c2)
+                output.append(self.underline)
+                output.append(token)
+                in_header = True
+
+            elif kind == "item":
+                ensure_color()
+                marker = token.strip()
+                indent = token[:token.index(marker)]
+                spacing = token[len(indent) + len(marker):]
+
+                output.append(indent)
+                start_color(self.c5)
+                output.append(marker)
+                end_color()
+                output.append(spacing)
+
+            elif kind == "code":
+                # No formatting inside backticks, and the backticks themselves
+                # don't get shown.
+                ensure_color()
+                start_color(self.c4)
+                output.append(token[1:-1] if token.endswith("`") and (len(token) > 1) else token[1:])
+                end_color()
+
+            elif kind == "link":
+                ensure_color()
+                lm = reLink.match(token)
+                assert lm is not None   # hush, mypy
+
+                output.append(self.underline)
+                output.append(lm.group(1))
+                output.append(self.end_underline)
+                output.append(" <")
+                start_color(self.c4)
+                output.append(lm.group(2))
+                end_color()
+                output.append(">")
+
+            elif kind == "strong":
+                ensure_color()
+                toggle("**", self.c5)
+
+            elif kind == "star":
+                ensure_color()
+                following = text[idx:idx+1]
+
+                if decorations and (decorations[-1] == "*"):
+                    # This is the end of a single asterisk decoration.
+                    toggle("*", self.c5)
+                elif following.isalnum() or (following == "\n"):
+                    # One asterisk is a decoration.
+                    toggle("*", self.c5)
+                else:
+                    # This is just a plain old asterisk, not the start of
+                    # anything.
+                    output.append(token)
+
+            elif kind == "under":
+                ensure_color()
+                toggle("_", self.c4)
+
+        if idx < len(text):
+            ensure_color()
+            output.append(text[idx:])
+
+        output.append(self.reset)
+
+        return "".join(output)
+
+
+# Renderers, one per set of terminal capabilities.
+_renderers: Dict[Caps, MarkdownRenderer] = {}
+
+
+def renderer(caps: Caps) -> MarkdownRenderer:
+    r = _renderers.get(caps, None)
+
+    if r is None:
+        r = MarkdownRenderer(caps)
+        _renderers[caps] = r
+
+    return r
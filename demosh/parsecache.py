@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+import hashlib
+import json
+import os
+import tempfile
+
+from . import __version__
+from .command import RawSingleValue, RawMultiValue, InputReader
+
+
+RawElement = Union[RawSingleValue, RawMultiValue]
+
+
+def cache_dir() -> str:
+    # Where do cache files live? $DEMOSH_CACHE_DIR wins, then the XDG cache
+    # directory, then ~/.cache.
+    path = os.environ.get("DEMOSH_CACHE_DIR", None)
+
+    if not path:
+        xdg = os.environ.get("XDG_CACHE_HOME", None) or os.path.expanduser("~/.cache")
+        path = os.path.join(xdg, "demosh")
+
+    return path
+
+
+# A ParseCache remembers the raw elements that InputReader.read_element
+# produces for each input, keyed on a hash of the input's mode and content,
+# and saves them in a .demoshc file so that the next run with the same inputs
+# doesn't have to tokenize anything. There's one cache file per top-level
+# script; it holds every input that script used the last time it ran (the
+# builtins, init files, imports, and macro and ifhook bodies).
+#
+# We cache the raw elements rather than Commands because turning hooks into
+# functions depends on the environment, so that still has to happen every
+# run.
+class ParseCache:
+    # Bump this if the format of the cache file, or the way InputReader
+    # tokenizes things, changes.
+    FORMAT = 3
+
+    def __init__(self, script: str, directory: Optional[str]=None, debug: bool=False) -> None:
+        if directory is None:
+            directory = cache_dir()
+
+        scriptkey = hashlib.sha256(os.path.abspath(script).encode('utf-8')).hexdigest()[:16]
+
+        self.path = os.path.join(directory, f"{scriptkey}.demoshc")
+        self.debug = debug
+        self.hits = 0
+        self.misses = 0
+
+        self._loaded: Dict[str, List[RawElement]] = {}
+        self._used: Dict[str, List[RawElement]] = {}
+
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if (data.get("format") != ParseCache.FORMAT) or (data.get("version") != __version__):
+            return
+
+        for key, encoded in data.get("inputs", {}).items():
+            self._loaded[key] = [ ParseCache.decode(e) for e in encoded ]
+
+    def save(self) -> None:
+        # Only rewrite the file if something changed: every input we used
+        # was already there, and nothing there went unused.
+        if not self.misses and (self._used.keys() == self._loaded.keys()):
+            return
+
+        data = {
+            "format": ParseCache.FORMAT,
+            "version": __version__,
+            "inputs": {
+                key: [ ParseCache.encode(e) for e in elements ]
+                for key, elements in self._used.items()
+            },
+        }
+
+        try:
+            directory = os.path.dirname(self.path)
+            os.makedirs(directory, exist_ok=True)
+
+            fd, tmppath = tempfile.mkstemp(dir=directory, suffix=".tmp")
+
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+
+            os.replace(tmppath, self.path)
+        except OSError as e:
+            if self.debug:
+                print(f"Could not save parse cache {self.path}: {e}")
+
+    @staticmethod
+    def key(mode: str, lines: Iterable[str]) -> str:
+        h = hashlib.sha256(f"{mode}\0".encode('utf-8'))
+
+        for line in lines:
+            h.update(line.encode('utf-8'))
+            h.update(b"\0")
+
+        return h.hexdigest()
+
+    @staticmethod
+    def encode(element: RawElement) -> List[Any]:
+        kind = "M" if isinstance(element, RawMultiValue) else "S"
+        return [ kind, element.type, element.name, element.value ]
+
+    @staticmethod
+    def decode(encoded: List[Any]) -> RawElement:
+        kind, type, name, value = encoded
+
+        if kind == "M":
+            return RawMultiValue(type, name, value)
+
+        return RawSingleValue(type, name, value)
+
+    def read(self, reader: InputReader) -> List[RawElement]:
+        # Read everything the reader has, then tokenize it only if we don't
+        # already have the answer.
+        lines = list(reader.input)
+        key = ParseCache.key(reader.mode, lines)
+
+        elements = self._loaded.get(key, None)
+
+        if elements is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            reader.input = iter(lines)
+            elements = list(reader.read_element())
+
+        self._used[key] = elements
+        return elements
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+from typing import Dict, List, Optional, Tuple
+
+import hashlib
+import os
+import shlex
+import shutil
+import tempfile
+
+
+# The Prelude is every shell function demosh knows about: the ones the script
+# defines, and the ones made for hooks. Every command needs them, so rather
+# than pasting all of them into every command, we write them to a file once
+# and have each command source it with a single line.
+#
+# The file is named for a hash of its contents, so it only gets written when
+# the set of functions actually changes. Old files stick around until close,
+# since a command that was just started might not have read its file yet.
+#
+# Defining a function that already exists replaces it, and functions can be
+# removed (for "unset -f"), so nothing piles up.
+class Prelude:
+    def __init__(self, directory: Optional[str]=None) -> None:
+        self._directory = directory
+        self._made_directory = False
+        self._functions: Dict[str, str] = {}
+        self._digest: Optional[str] = None
+
+    def define(self, name: str, definition: str) -> None:
+        # Redefining a function moves it to the end, just as though all the
+        # definitions were run in order.
+        self._functions.pop(name, None)
+        self._functions[name] = definition
+        self._digest = None
+
+    def remove(self, name: str) -> bool:
+        if name not in self._functions:
+            return False
+
+        del self._functions[name]
+        self._digest = None
+        return True
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._functions
+
+    def __len__(self) -> int:
+        return len(self._functions)
+
+    def names(self) -> List[str]:
+        return list(self._functions.keys())
+
+    def definitions(self) -> List[str]:
+        return list(self._functions.values())
+
+    def items(self) -> List[Tuple[str, str]]:
+        return list(self._functions.items())
+
+    def load(self, items: List[Tuple[str, str]]) -> None:
+        # Replace everything with items, e.g. from a checkpoint.
+        self._functions = { name: definition for name, definition in items }
+        self._digest = None
+
+    def text(self) -> str:
+        return "\n".join(self._functions.values()) + "\n"
+
+    def digest(self) -> str:
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.text().encode('utf-8')).hexdigest()
+
+        return self._digest
+
+    def path(self) -> str:
+        # Return the path of the file holding the current functions, writing
+        # it if need be.
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix="demosh-")
+            self._made_directory = True
+
+        path = os.path.join(self._directory, f"prelude-{self.digest()[:16]}.sh")
+
+        if not os.path.exists(path):
+            fd, tmppath = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+
+            with os.fdopen(fd, "w") as f:
+                f.write(self.text())
+
+            os.replace(tmppath, path)
+
+        return path
+
+    def source_line(self) -> str:
+        # The line that a command needs to get all the functions.
+        if not self._functions:
+            return ""
+
+        return f". {shlex.quote(self.path())}"
+
+    def close(self) -> None:
+        if self._made_directory and (self._directory is not None):
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+            self._made_directory = False
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+from typing import Any, Callable, ContextManager, Dict, Iterator, Optional, TypeVar, cast
+
+import sys
+
+import contextlib
+import cProfile
+import functools
+import time
+
+
+# The Profiler adds up how much time demosh spends in each phase of startup
+# (imports, terminal setup, parsing) and of running a demo (typing, display,
+# Markdown rendering, variable expansion, subprocesses). It's a module-level
+# singleton, PROFILER, so that any part of demosh can report phases without
+# having to have it passed in; when it's not enabled, phase() costs next to
+# nothing.
+#
+# Phases can nest (for example, parsing macros happens while parsing the
+# script that defines them), so the totals don't necessarily add up to the
+# total run time.
+class Profiler:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.totals: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.cprofile: Optional[cProfile.Profile] = None
+        self._null = contextlib.nullcontext()
+
+    def enable(self, cprofile: bool=False) -> None:
+        self.enabled = True
+
+        if cprofile:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def add(self, name: str, seconds: float) -> None:
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def phase(self, name: str) -> ContextManager:
+        if not self.enabled:
+            return self._null
+
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def report(self) -> str:
+        lines = [ "demosh profile (phases may nest):" ]
+
+        for name, total in sorted(self.totals.items(), key=lambda x: x[1], reverse=True):
+            count = self.counts[name]
+            lines.append(f"  {name:<28} {total * 1000:10.1f} ms  {count:7d} calls  {total * 1e6 / count:10.1f} us/call")
+
+        return "\n".join(lines)
+
+    def finish(self, dump_path: Optional[str]=None) -> None:
+        if self.cprofile is not None:
+            self.cprofile.disable()
+
+            if dump_path:
+                self.cprofile.dump_stats(dump_path)
+
+        sys.stderr.write(self.report() + "\n")
+        sys.stderr.flush()
+
+
+PROFILER = Profiler()
+
+
+F = TypeVar('F', bound=Callable[..., Any])
+
+
+def profiled(name: str) -> Callable[[F], F]:
+    # Decorator to count every call to a function as the named phase.
+    def decorate(fn: F) -> F:
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not PROFILER.enabled:
+                return fn(*args, **kwargs)
+
+            started = time.perf_counter()
+
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                PROFILER.add(name, time.perf_counter() - started)
+
+        return cast(F, wrapper)
+
+    return decorate
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from . import __version__
+from .parsecache import cache_dir
+
+
+# A Result is what a cached command produced.
+class Result:
+    def __init__(self, rc: int, stdout: bytes, stderr: bytes) -> None:
+        self.rc = rc
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+# A ResultCache stores the output of #@cache commands on disk, so that
+# rerunning a demo can replay them instantly. Each entry is three files named
+# for its key: KEY.json (exit status and expiry), KEY.out, and KEY.err. It's
+# an LRU: a hit touches the entry, and when the whole thing gets bigger than
+# max_bytes, the least recently used entries get thrown out.
+class ResultCache:
+    # Bump this if the format of the entries changes.
+    FORMAT = 1
+
+    MaxBytes = 256 * 1024 * 1024
+
+    def __init__(self, directory: Optional[str]=None, max_bytes: Optional[int]=None,
+                 debug: bool=False) -> None:
+        if directory is None:
+            directory = os.path.join(cache_dir(), "results")
+
+        self.directory = directory
+        self.max_bytes = max_bytes if (max_bytes is not None) else ResultCache.MaxBytes
+        self.debug = debug
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(cmd: str, cwd: str, env: Dict[str, str], names: Iterable[str], prelude: str="") -> str:
+        # The key covers the command (already expanded), where it runs, the
+        # functions it can call, and the values of the environment variables
+        # named in names.
+        h = hashlib.sha256(f"{ResultCache.FORMAT}\0{__version__}\0{cmd}\0{cwd}\0".encode('utf-8'))
+        h.update(hashlib.sha256(prelude.encode('utf-8')).digest())
+
+        for name in sorted(set(names)):
+            value = env.get(name, None)
+            h.update(f"{name}={value}\0".encode('utf-8') if value is not None else f"{name}\0".encode('utf-8'))
+
+        return h.hexdigest()
+
+    def paths(self, key: str) -> Tuple[str, str, str]:
+        base = os.path.join(self.directory, key)
+        return f"{base}.json", f"{base}.out", f"{base}.err"
+
+    def get(self, key: str) -> Optional[Result]:
+        metapath, outpath, errpath = self.paths(key)
+
+        try:
+            with open(metapath, "r") as f:
+                meta = json.load(f)
+
+            expires = meta.get("expires", None)
+
+            if (expires is not None) and (time.time() >= expires):
+                self.remove(key)
+                self.misses += 1
+                return None
+
+            with open(outpath, "rb") as f:
+                stdout = f.read()
+
+            with open(errpath, "rb") as f:
+                stderr = f.read()
+
+            # Mark it as recently used.
+            os.utime(metapath)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return Result(meta["rc"], stdout, stderr)
+
+    def put(self, key: str, result: Result, ttl: Optional[float]) -> None:
+        metapath, outpath, errpath = self.paths(key)
+
+        meta = {
+            "rc": result.rc,
+            "expires": (time.time() + ttl) if ttl else None,
+        }
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+
+            # Write the metadata last, since it's what makes the entry count.
+            for path, data in ((outpath, result.stdout), (errpath, result.stderr),
+                               (metapath, json.dumps(meta).encode('utf-8'))):
+                fd, tmppath = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+
+                os.replace(tmppath, path)
+        except OSError as e:
+            if self.debug:
+                print(f"Could not save cached result {key}: {e}")
+
+            return
+
+        self.evict()
+
+    def remove(self, key: str) -> None:
+        for path in self.paths(key):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def evict(self) -> None:
+        # Throw out least recently used entries until we fit in max_bytes.
+        entries: List[Tuple[float, int, str]] = []
+        total = 0
+
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+
+            key = name[:-5]
+            size = 0
+            used = 0.0
+
+            for path in self.paths(key):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+
+                size += st.st_size
+
+                if path.endswith(".json"):
+                    used = st.st_mtime
+
+            entries.append((used, size, key))
+            total += size
+
+        entries.sort()
+
+        while entries and (total > self.max_bytes):
+            _, size, key = entries.pop(0)
+
+            if self.debug:
+                print(f"Evicting cached result {key}")
+
+            self.remove(key)
+            total -= size
@@ -22,15 +22,28 @@
 # For more info, see README.md. If you've somehow found demosh without also
 # finding its repo, it's at github.com/BuoyantIO/demosh.
 
-from typing import Dict, List, Set, TYPE_CHECKING
+from typing import Any, Dict, List, Match, Optional, Set, Tuple, TYPE_CHECKING
 
 import sys
 
+import math
 import os
+import random
 import re
+import select
 import shlex
 import signal
 import subprocess
+import tempfile
+import time
+
+from . import launcher
+from .coprocess import Coprocess
+from .hooksocket import HookSocket
+from .jobs import Job
+from .prelude import Prelude
+from .resultcache import Result, ResultCache
+from .profiler import profiled
 
 if TYPE_CHECKING:
     from .command import Command
@@ -44,27 +57,176 @@ reAssignment = re.compile(r"^\s*(export\s+)?([a-zA-Z0-9_]+)=")
 # looks like to us.
 reFunction = re.compile(r"^\s*(function\s+)?([a-zA-Z0-9_]+)\s*\(\)\s+\{")
 
+# A word made only of these characters means exactly what it says to the
+# shell: no expansions, no quoting, no globbing, no word splitting.
+reLiteral = re.compile(r"^[a-zA-Z0-9_./:@%+,=-]*$")
+
+# Likewise, single quotes with no single quotes inside, or double quotes with
+# nothing inside that the shell would treat specially.
+reSingleQuoted = re.compile(r"^'([^']*)'$")
+reDoubleQuoted = re.compile(r'^"([^"$`\\]*)"$')
+
+# This is what a variable reference looks like to expand_env: ${NAME},
+# ${NAME:-default}, or ${1} (groups 1 and 2), or $NAME or $1 (group 3).
+reExpansion = re.compile(r"\$(?:\{([a-zA-Z_][a-zA-Z0-9_]*|[0-9]+)(?::-((?:\$\{[^{}]*\}|[^}])*))?\}|([a-zA-Z_][a-zA-Z0-9_]*|[0-9]))")
+
+# A duration, like 30s, 5m, or 1.5h.
+reDuration = re.compile(r"^([0-9]+(?:\.[0-9]+)?)([smh])$")
+
+# A plain number, like 30 or 1.5.
+reNumber = re.compile(r"^[0-9]+(?:\.[0-9]+)?$")
+
+
+def parse_duration(word: str) -> Optional[float]:
+    # Return the number of seconds in a duration, or None if word isn't one.
+    m = reDuration.match(word)
+
+    if not m:
+        return None
+
+    return float(m.group(1)) * { "s": 1, "m": 60, "h": 3600 }[m.group(2)]
+
+
+def parse_waitfor(cmd: str) -> Tuple[str, float]:
+    # Split "waitfor <condition> [timeout]" into the condition and the
+    # timeout in seconds. A condition that's a single quoted string gets
+    # unquoted. Raises ValueError if the timeout is no good.
+    rest = cmd.strip()[7:].strip()
+    words = rest.rsplit(None, 1)
+    timeout = ShellState.WaitforTimeout
+
+    if len(words) == 2:
+        duration = parse_duration(words[1])
+
+        try:
+            quoted = (len(shlex.split(words[0])) == 1) and (words[0][:1] in ("'", '"'))
+        except ValueError:
+            quoted = False
+
+        if (duration is None) and quoted:
+            # After a quoted condition, the last word can only be meant as
+            # the timeout. A plain number is seconds; anything else is a
+            # mistake, and we shouldn't run it as part of the condition.
+            if not reNumber.match(words[1]):
+                raise ValueError(f"invalid waitfor timeout: {words[1]}")
+
+            duration = float(words[1])
+
+        if duration is not None:
+            rest = words[0]
+            timeout = duration
+
+    try:
+        fields = shlex.split(rest)
+    except ValueError:
+        fields = []
+
+    condition = fields[0] if len(fields) == 1 else rest
+
+    return condition, timeout
+
+
+def write_all(fd: int, data: bytes) -> None:
+    # os.write can write less than we asked it to (to a terminal or a pipe,
+    # say), so keep going until it's all out.
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+def literal_word(word: str) -> Optional[str]:
+    # If word is something that the shell would take literally, return
+    # what the shell would make of it. Otherwise, return None, and we'll
+    # have to ask the shell.
+    if reLiteral.match(word):
+        return word
+
+    m = reSingleQuoted.match(word) or reDoubleQuoted.match(word)
+
+    if m:
+        return m.group(1)
+
+    return None
+
+# A Spinner shows that we're waiting for something, on a single line that
+# gets redrawn in place.
+class Spinner:
+    Frames = "|/-\\"
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.frame = 0
+        self.started = time.monotonic()
+
+    def spin_for(self, seconds: float) -> None:
+        end = time.monotonic() + seconds
+
+        while True:
+            now = time.monotonic()
+
+            sys.stdout.write(f"\r{Spinner.Frames[self.frame % 4]} {self.text} ({now - self.started:.0f}s)")
+            sys.stdout.flush()
+            self.frame += 1
+
+            if now >= end:
+                break
+
+            time.sleep(min(0.1, end - now))
+
+    def clear(self) -> None:
+        sys.stdout.write("\r\033[K")
+        sys.stdout.flush()
+
+
 class ShellState:
-    @staticmethod
-    def ignore_signals() -> None:
-        # print(f"Ignoring signals in {os.getpid()}")
-        signal.signal(signal.SIGINT, signal.SIG_IGN)
-        signal.signal(signal.SIGTERM, signal.SIG_IGN)
-
-    @staticmethod
-    def allow_signals() -> None:
-        # print(f"Allowing signals in {os.getpid()}")
-        signal.signal(signal.SIGINT, signal.SIG_DFL)
-        signal.signal(signal.SIGTERM, signal.SIG_DFL)
-
-    def __init__(self, argv0, script: str, args: List[str]) -> None:
+    # How long #@waitfor waits by default, and the range of its delays
+    # between tries.
+    WaitforTimeout = 300.0
+    WaitforMinDelay = 0.1
+    WaitforMaxDelay = 5.0
+
+    def __init__(self, argv0, script: str, args: List[str],
+                 persistent: Optional[bool]=False) -> None:
         self.cwd = os.getcwd()
         self.env = os.environ.copy()
-        self.functions: List[str] = []
+        self.prelude = Prelude()
         self.macros: Dict[str, 'DemoState'] = {}
         self.exit_on_failure = False
+
+        # Whether the script itself has done "set -e". exit_on_failure can
+        # also come from the command line (--batch), so this is what goes
+        # into a checkpoint.
+        self.errexit = False
+
+        # How many commands have failed, and whether we're stopping (because
+        # of a failure with "set -e", or because the user quit). stopping is
+        # here rather than in DemoState so that it stops macros' callers too.
+        self.failures = 0
+        self.stopping = False
         self._hooks: Set[str] = set()
 
+        # Every hook the script declared, whether present or not, so that we
+        # know to send them to the hook socket, if there is one.
+        self.hook_names: Set[str] = set()
+        self.hook_socket: Optional[HookSocket] = None
+
+        if os.environ.get("DEMO_HOOK_SOCKET", None):
+            self.hook_socket = HookSocket(os.environ["DEMO_HOOK_SOCKET"])
+
+        # env_generation changes whenever the environment does, so that
+        # expand_env can cache its results.
+        self.env_generation = 0
+        self._expand_generation = 0
+        self._expand_cache: Dict[Tuple[str, bool, bool], str] = {}
+
+        # Where child processes read their input from. None means our own
+        # stdin; this gets changed if the script itself is arriving on stdin.
+        self.stdin: Optional[int] = None
+
+        # When resuming from a checkpoint, where each level of DemoState.run
+        # should start (outermost first). Each run takes the first entry.
+        self.resume: List[Dict[str, Any]] = []
+
         self.shell = os.environ.get("SHELL", "/bin/sh")
         self.env["SHELL"] = os.path.abspath(argv0)
 
@@ -77,14 +239,96 @@ class ShellState:
             # print(f">> set ${i} = {self.env[str(i)]}")
             i += 1
 
-        ShellState.ignore_signals()
+        # If we're asked for a persistent shell, commands all get run by
+        # a single bash coprocess rather than a new shell per command. We
+        # start it lazily, on the first command.
+        self.coprocess: Optional[Coprocess] = None
+
+        if persistent:
+            self.coprocess = Coprocess()
+
+        self._evaluator: Optional[Coprocess] = None
+
+        # Background jobs (from #@background and #@prefetch), by name.
+        self.jobs: Dict[str, Job] = {}
+        self._prefetches = 0
+
+        self._waitfor_random = random.Random()
+
+        # Where #@cache keeps results. None means that #@cache does nothing.
+        self.result_cache: Optional[ResultCache] = None
+
+        launcher.ignore_signals()
+
+    def close(self) -> None:
+        for name, job in self.jobs.items():
+            if not job.done():
+                print(f"stopping background job {name}")
+
+            job.stop()
+
+        self.jobs = {}
+
+        if self.coprocess is not None:
+            self.coprocess.close()
+
+        if self._evaluator is not None:
+            self._evaluator.close()
+
+        self.prelude.close()
+
+        if self.hook_socket is not None:
+            self.hook_socket.close()
+
+    def setenv(self, name: str, value: str) -> None:
+        # Always change the environment through here, so that anything
+        # cached based on it gets thrown away.
+        self.env[name] = value
+        self.env_generation += 1
+
+    @profiled("run: expand_env")
+    def expand_env(self, s: str, bare: bool=False) -> str:
+        # Expand ${NAME}, ${NAME:-default}, and ${1}; if bare is set, also
+        # expand $NAME and $1. References to things that aren't set are
+        # left alone (unless they have a default).
+        return self._expand(s, bare, False)
+
+    def expand_positional(self, s: str) -> str:
+        # Expand only positional parameters, both $1 and ${1}.
+        return self._expand(s, True, True)
+
+    def _expand(self, s: str, bare: bool, positional_only: bool) -> str:
+        if self._expand_generation != self.env_generation:
+            self._expand_cache = {}
+            self._expand_generation = self.env_generation
+
+        key = (s, bare, positional_only)
+        expanded = self._expand_cache.get(key, None)
 
-    def expand_env(self, s: str) -> str:
-        for k in self.env.keys():
-            bracketed = '${%s}' % k
-            s = s.replace(bracketed, self.env[k])
+        if expanded is None:
+            def replace(m: Match[str]) -> str:
+                name = m.group(1) or m.group(3)
 
-        return s
+                if (m.group(3) and not bare) or (positional_only and not name.isdigit()):
+                    return m.group(0)
+
+                value = self.env.get(name, None)
+
+                if m.group(2) is not None:
+                    # ${NAME:-default} uses the default if NAME is unset
+                    # _or_ empty.
+                    if not value:
+                        value = self._expand(m.group(2), bare, positional_only)
+
+                if value is None:
+                    return m.group(0)
+
+                return value
+
+            expanded = reExpansion.sub(replace, s)
+            self._expand_cache[key] = expanded
+
+        return expanded
 
     def subshell(self, demostate: 'DemoState') -> None:
         self.do_shell_command(demostate, f"{self.shell} -i")
@@ -96,6 +340,13 @@ class ShellState:
         if cmd.ismeta():
             cmdline = cmdline[2:]
 
+        if cmd.prefetch and cmd.background:
+            # This already started when it was read, so just wait for it.
+            return self.do_join(demostate, f"join {shlex.quote(cmd.background)}")
+
+        if cmd.background:
+            return self.start_background(cmd.background, cmdline)
+
         rc = 127
 
         # cmdline = self.expand_env(cmdline)
@@ -115,14 +366,14 @@ class ShellState:
             cmdline = f"{m.group(2)}() {{" + cmdline[m.end():]
             # print(f"Function: {cmdline}")
 
-            self.functions.append(cmdline)
+            self.prelude.define(m.group(2), cmdline)
             return 0
 
-        rc = self.run_command(demostate, cmdline)
+        rc = self.run_command(demostate, cmdline, cache=cmd.cache)
 
         return rc
 
-    def run_command(self, demostate: 'DemoState', cmdline: str) -> int:
+    def run_command(self, demostate: 'DemoState', cmdline: str, cache: float=0) -> int:
         rc = 127
 
         try:
@@ -133,6 +384,17 @@ class ShellState:
 
         first = fields[0]
 
+        # Hook that the hook socket can handle? That's only a plain call, with
+        # nothing but literal arguments: anything fancier (like "hook && cmd",
+        # redirections, or expansions) needs a shell. If the socket doesn't
+        # work, we fall through to the hook's shell function.
+        if ((first in self.hook_names) and (self.hook_socket is not None) and
+            all((literal_word(word) is not None) for word in cmdline.split())):
+            socket_rc = self.hook_socket.call(cmdline)
+
+            if socket_rc is not None:
+                return socket_rc
+
         # Macro?
         if first in self.macros:
             # print(f"macro: {first}")
@@ -146,11 +408,103 @@ class ShellState:
             if not handler:
                 handler = self.do_shell_command
 
+                if cache and (self.result_cache is not None):
+                    return self.run_cached(cmdline, cache)
+
             rc = handler(demostate, cmdline)
 
         # print(f"{first}: rc={rc}")
         return rc
 
+    @profiled("run: waitfor")
+    def do_waitfor(self, demostate: 'DemoState', cmd: str) -> int:
+        # Wait for a condition: run it over and over, backing off
+        # exponentially (with some jitter, so that several demos polling the
+        # same thing don't end up in lockstep), until it succeeds or we time
+        # out. Its output only gets shown if we time out.
+        try:
+            condition, timeout = parse_waitfor(cmd)
+        except ValueError as e:
+            print(f"waitfor: {e}")
+            return 1
+
+        if not condition:
+            print("waitfor: what should we wait for?")
+            return 1
+
+        spinner = None
+
+        if (demostate is not None) and demostate.showing and not demostate.batch:
+            spinner = Spinner(f"waiting for {condition}")
+
+        started = time.monotonic()
+        deadline = started + timeout
+        delay = ShellState.WaitforMinDelay
+        output = b""
+        rc = 1
+
+        while True:
+            proc = self.spawn(condition, stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+            try:
+                output, _ = proc.communicate(timeout=max(deadline - time.monotonic(), 0.1))
+                rc = proc.returncode
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                output, _ = proc.communicate()
+                rc = 1
+
+            if (rc == 0) or (rc == -signal.SIGINT):
+                # Done, or the presenter hit ^C to give up.
+                break
+
+            now = time.monotonic()
+
+            if now >= deadline:
+                break
+
+            pause = min(self._waitfor_random.uniform(delay / 2, delay), deadline - now)
+
+            if spinner:
+                spinner.spin_for(pause)
+            else:
+                time.sleep(pause)
+
+            delay = min(delay * 2, ShellState.WaitforMaxDelay)
+
+        elapsed = time.monotonic() - started
+
+        if spinner:
+            spinner.clear()
+
+        if rc == 0:
+            if spinner:
+                print(f"...ready after {elapsed:.1f}s")
+
+            return 0
+
+        sys.stdout.write(output.decode('utf-8', errors='replace'))
+
+        if rc == -signal.SIGINT:
+            print(f"...gave up waiting for {condition}")
+        else:
+            print(f"...timed out after {elapsed:.1f}s waiting for {condition}")
+
+        return 1
+
+    def prefetch(self, cmd: 'Command') -> None:
+        # Start cmd in the background right now, well before it gets run, so
+        # that by the time it does get run it's (hopefully) done.
+        cmdline = cmd.cmdline
+
+        if cmd.ismeta():
+            cmdline = cmdline[2:]
+
+        self._prefetches += 1
+        cmd.background = f"prefetch-{self._prefetches}"
+        self.start_background(cmd.background, cmdline)
+
     def do_wait(self, demostate: 'DemoState', cmd: str) -> int:
         # Nothing to do for this!
         return 0
@@ -158,105 +512,285 @@ class ShellState:
     def do_print(self, demostate: 'DemoState', cmd: str) -> int:
         text = " ".join(shlex.split(cmd[6:]))
 
-        text = self.expand_env(text)
+        text = self.expand_env(text, bare=True)
 
         demostate.display(text, force=True)
         return 0
 
+    def do_unset(self, demostate: 'DemoState', cmd: str) -> int:
+        # "unset -f" removes functions from the prelude. Anything else goes
+        # to the shell as usual.
+        fields = shlex.split(cmd)
+
+        if (len(fields) < 3) or (fields[1] != "-f"):
+            return self.do_shell_command(demostate, cmd)
+
+        for name in fields[2:]:
+            self.prelude.remove(name)
+
+        return 0
+
     def do_set(self, demostate: 'DemoState', cmd: str) -> int:
-        # Handle "set". Currently we just honor set -e.
+        # Handle "set". We honor set -e ourselves, by stopping the demo. With
+        # a persistent shell, everything else gets passed along to it, so
+        # that things like set -o pipefail stick; otherwise there's no shell
+        # for them to stick in, so they do nothing.
         fields = shlex.split(cmd)
         flags = fields[1]
 
-        value = True
-
-        if flags[0] == "-":
-            value = True
-        elif flags[0] == "+":
-            value = False
-        else:
+        if flags[0] not in "-+":
             sys.stderr.write(f"Unknown set flag: {flags[0]}\n")
             sys.stderr.flush()
             return 1
 
-        for flag in flags:
-            if flag == "e":
-                self.exit_on_failure = value
+        forward: List[str] = []
+
+        for field in fields[1:]:
+            value = field.startswith("-")
+
+            if forward and (forward[-1] in ("-o", "+o")) and (field == "errexit"):
+                # set -o errexit is set -e.
+                self.errexit = (forward.pop() == "-o")
+                self.exit_on_failure = self.errexit
+
+            elif (field[:1] in ("-", "+")) and (field not in ("-o", "+o")):
+                if "e" in field[1:]:
+                    self.errexit = value
+                    self.exit_on_failure = value
+                    field = field.replace("e", "")
+
+                if len(field) > 1:
+                    forward.append(field)
+
+            else:
+                forward.append(field)
+
+        if forward and (self.coprocess is not None):
+            return self.coprocess.run(self, "set " + " ".join(shlex.quote(f) for f in forward))
 
         return 0
 
+    def evaluator(self) -> Coprocess:
+        # Assignments and cd get evaluated by a persistent bash, so that we
+        # don't pay for a new shell (and the whole function prelude) for every
+        # one of them. If we have a persistent shell already, just use that;
+        # otherwise start one just for evaluation. Either way, its output
+        # goes to ours, so that things like "cd foo && ls" show the ls.
+        if self.coprocess is not None:
+            return self.coprocess
+
+        if self._evaluator is None:
+            self._evaluator = Coprocess()
+
+        return self._evaluator
+
+    @profiled("run: cd")
     def do_cd(self, demostate: 'DemoState', cmd: str) -> int:
-        proc = subprocess.Popen(["bash"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                cwd=self.cwd, env=self.env, close_fds=True)
+        # Fast path: "cd" to a literal directory doesn't need a shell at
+        # all. (If CDPATH is set, bash might do something cleverer, so let
+        # bash handle it.)
+        try:
+            fields = shlex.split(cmd)
+        except ValueError:
+            fields = []
+
+        if (len(fields) == 2) and ("CDPATH" not in self.env):
+            path = literal_word(cmd.strip()[2:].strip())
 
-        assert proc.stdin is not None   # hush, mypy
-        proc.stdin.write(cmd.encode('utf-8'))
-        proc.stdin.write("pwd\n".encode('utf-8'))
+            if path and (path != "-"):
+                newcwd = os.path.normpath(os.path.join(self.cwd, path))
 
-        stdout, stderr = proc.communicate()
+                if os.path.isdir(newcwd):
+                    self.cwd = newcwd
+                    return 0
 
-        if proc.returncode == 0:
-            self.cwd = stdout.decode('utf-8').strip()
+        rc, _, cwd = self.evaluator().evaluate(self, cmd)
+
+        if rc == 0:
+            self.cwd = cwd
             return 0
 
-        print("cd failed: %s" % stderr.decode('utf-8'))
+        print("cd failed")
         return 1
 
+    @profiled("run: assign")
     def do_assign(self, demostate: 'DemoState', name: str, value: str) -> int:
-        i = 0
+        value = self.expand_positional(value)
 
-        while True:
-            envvar = self.env.get(str(i), None)
-            if envvar is None:
-                break
-            value = value.replace("$%d" % i, envvar)
-            value = value.replace("${%d}" % i, envvar)
+        # print("assign '%s' = '%s'" % (name, value))
 
-            i += 1
+        # Fast path: a literal value doesn't need a shell to evaluate it.
+        literal = literal_word(value.strip())
 
-        # print("assign '%s' = '%s'" % (name, value))
+        if literal is not None:
+            self.setenv(name, literal.strip())
+            return 0
+
+        # Only an assignment that the shell can't even run (a syntax error,
+        # say) counts as failing: "FOO=$(false)" sets FOO to an empty string
+        # and succeeds, as it always has. Hence the trailing ":".
+        rc, result, cwd = self.evaluator().evaluate(self, f'{name}={value}\n:', name)
+
+        # print("assign rc: %d" % rc)
+        # print("assign result: '%s'" % result)
+
+        if rc == 0:
+            self.setenv(name, result.strip())
+            self.cwd = cwd
+            # print("assign final: '%s' = '%s'" % (name, self.env[name]))
+            return 0
+
+        print("assignment failed!")
+        return 1
+
+    def spawn(self, cmd: str, **kwargs) -> subprocess.Popen:
+        # Start cmd in a new shell, with our functions, environment, and
+        # working directory. kwargs go straight to launcher.spawn.
+        allcmd = self.prelude.source_line() + "\n" + cmd
+
+        return launcher.spawn(allcmd, shell=True, cwd=self.cwd, env=self.env, close_fds=True, **kwargs)
+
+    def start_job(self, name: str, cmd: str) -> Job:
+        # Start cmd in the background, with its output going to a temporary
+        # file, and with no input: it can't share the terminal.
+        output = tempfile.TemporaryFile()
+        proc = self.spawn(cmd, stdin=subprocess.DEVNULL, stdout=output, stderr=subprocess.STDOUT)
+
+        return Job(name, cmd, proc, output)
+
+    def run_parallel(self, cmds: List[str]) -> List[int]:
+        # Run all of cmds at once, each in its own shell, and return their
+        # exit statuses. Since they all start from the same ShellState and
+        # none of them can change it, they can't affect each other (at least
+        # not from demosh's point of view).
+        #
+        # Each command's output is printed all together once it finishes,
+        # with a prefix saying which command it came from, so that the
+        # outputs don't get interleaved.
+        running = { i: self.start_job(str(i + 1), cmd) for i, cmd in enumerate(cmds) }
+        rcs = [ 0 ] * len(cmds)
+
+        while running:
+            finished = [ i for i, job in running.items() if job.done() ]
+
+            if not finished:
+                time.sleep(0.02)
+                continue
+
+            for i in finished:
+                job = running.pop(i)
+                rcs[i] = job.wait()
+                job.show(prefix=f"[{job.name}] ")
+
+        return rcs
+
+    def start_background(self, name: str, cmd: str) -> int:
+        if name in self.jobs:
+            print(f"there's already a background job named {name}")
+            return 1
+
+        self.jobs[name] = self.start_job(name, cmd)
+        return 0
+
+    def do_join(self, demostate: 'DemoState', cmd: str) -> int:
+        # Wait for background jobs (all of them, if no names are given) and
+        # show their output. The exit status is that of the first one that
+        # failed.
+        names = shlex.split(cmd)[1:]
+
+        if not names:
+            names = list(self.jobs.keys())
 
-        proc = subprocess.Popen(["bash"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                cwd=self.cwd, env=self.env, close_fds=True)
+        rc = 0
 
-        assert proc.stdin is not None   # hush, mypy
+        for name in names:
+            job = self.jobs.pop(name, None)
 
-        fn = "\n".join(self.functions) + "\n"
-        c1 = f'{name}={value}'
-        c2 = f'echo "${name}"'
+            if job is None:
+                print(f"no background job named {name}")
+                rc = rc or 1
+                continue
 
-        # print("assign c1: '%s'" % c1)
-        # print("assign c2: '%s'" % c2)
+            jobrc = job.wait()
+            job.show()
 
-        proc.stdin.write(fn.encode('utf-8'))
-        proc.stdin.write(c1.encode('utf-8'))
-        proc.stdin.write("\n".encode('utf-8'))
-        proc.stdin.write(c2.encode('utf-8'))
-        proc.stdin.write("\n".encode('utf-8'))
+            rc = rc or jobrc
 
-        stdout, stderr = proc.communicate()
+        return rc
+
+    # These environment variables always go into the key for a cached
+    # result, since they change what so many commands do.
+    CacheContextVars = ( "PATH", "KUBECONFIG" )
+
+    @profiled("run: cached command")
+    def run_cached(self, cmd: str, ttl: float) -> int:
+        # Run cmd, or replay its output if we ran it before (with the same
+        # environment) recently enough. ttl is how long to keep a new result
+        # around, in seconds; math.inf means forever.
+        assert self.result_cache is not None    # hush, mypy
 
-        # print("assign rc: %d" % proc.returncode)
-        # print("assign stdout: '%s'" % stdout.decode('utf-8'))
-        # print("assign stderr: '%s'" % stderr.decode('utf-8'))
+        names = list(ShellState.CacheContextVars)
 
-        if stderr:
-            sys.stdout.write(stderr.decode('utf-8'))
+        for text in (cmd, self.prelude.text()):
+            names.extend((m.group(1) or m.group(3)) for m in reExpansion.finditer(text))
+
+        key = ResultCache.key(self.expand_env(cmd, bare=True), self.cwd, self.env, names,
+                              self.prelude.digest())
+        result = self.result_cache.get(key)
+
+        if result is not None:
             sys.stdout.flush()
+            sys.stderr.flush()
 
-        if proc.returncode == 0:
-            self.env[name] = stdout.decode('utf-8').strip()
-            # print("assign final: '%s' = '%s'" % (name, self.env[name]))
-            return 0
+            write_all(1, result.stdout)
+            write_all(2, result.stderr)
+            return result.rc
 
-        print("assignment failed!")
-        return 1
+        # Not cached, so run it, copying its output to ours as it arrives
+        # and keeping a copy. Only successes get cached: a failure is more
+        # likely to be something going wrong than the right answer.
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        proc = self.spawn(cmd, stdin=self.stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        assert (proc.stdout is not None) and (proc.stderr is not None)    # hush, mypy
+
+        out_fd = proc.stdout.fileno()
+        err_fd = proc.stderr.fileno()
+
+        captured = { out_fd: b"", err_fd: b"" }
+        copyto = { out_fd: 1, err_fd: 2 }
+        open_fds = [ out_fd, err_fd ]
+
+        while open_fds:
+            ready, _, _ = select.select(open_fds, [], [])
+
+            for fd in ready:
+                data = os.read(fd, 65536)
+
+                if not data:
+                    open_fds.remove(fd)
+                    continue
+
+                write_all(copyto[fd], data)
+                captured[fd] += data
+
+        rc = proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+
+        if rc == 0:
+            self.result_cache.put(key, Result(rc, captured[out_fd], captured[err_fd]),
+                                  None if math.isinf(ttl) else ttl)
+
+        return rc
 
+    @profiled("run: shell command")
     def do_shell_command(self, demostate: 'DemoState', cmd: str) -> int:
-        allcmd = "\n".join(self.functions) + "\n" + cmd
+        if self.coprocess is not None:
+            return self.coprocess.run(self, cmd)
 
-        proc = subprocess.Popen(allcmd, shell=True,
-                                cwd=self.cwd, env=self.env, close_fds=True, preexec_fn=ShellState.allow_signals)
+        proc = self.spawn(cmd, stdin=self.stdin)
 
         proc.wait()
         # print("proc finished: %d" % proc.returncode)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+# demosh-suite runs a whole bunch of demos in batch mode, in parallel, and
+# reports how each of them (and each command in them) did, as JSON and/or
+# JUnit XML.
+
+from typing import Any, Dict, List, Optional, TYPE_CHECKING
+
+import sys
+
+import argparse
+import concurrent.futures
+import glob
+import json
+import os
+import tempfile
+import time
+import traceback
+import xml.etree.ElementTree as ET
+
+from . import __version__
+from .shellstate import ShellState
+from .demostate import DemoState
+from .trace import Tracer
+
+if TYPE_CHECKING:
+    from .command import Command
+
+
+# A RecordingShellState is a ShellState that records the exit status, run
+# time, and output of every command it runs. Output is captured by having
+# fds 1 and 2 point at a file, so we just note where in the file each
+# command's output starts and ends.
+class RecordingShellState(ShellState):
+    def __init__(self, argv0, script: str, args: List[str], capture_fd: int,
+                 persistent: Optional[bool]=False) -> None:
+        super().__init__(argv0, script, args, persistent=persistent)
+        self.capture_fd = capture_fd
+        self.records: List[Dict[str, Any]] = []
+
+    def offset(self) -> int:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        return os.lseek(self.capture_fd, 0, os.SEEK_CUR)
+
+    def run(self, demostate: 'DemoState', cmd: 'Command') -> int:
+        record: Dict[str, Any] = {
+            "command": cmd.cmdline.rstrip(),
+            "start": self.offset(),
+        }
+
+        self.records.append(record)
+
+        started = time.perf_counter()
+        rc = super().run(demostate, cmd)
+
+        record["seconds"] = time.perf_counter() - started
+        record["rc"] = rc
+        record["end"] = self.offset()
+
+        return rc
+
+
+def find_demos(specs: List[str]) -> List[str]:
+    # Each spec is a directory (search it for .sh and .md files), a glob, or
+    # just a file.
+    demos: List[str] = []
+
+    for spec in specs:
+        if os.path.isdir(spec):
+            for ext in ("sh", "md"):
+                demos.extend(glob.glob(os.path.join(spec, "**", f"*.{ext}"), recursive=True))
+        elif glob.has_magic(spec):
+            demos.extend(glob.glob(spec, recursive=True))
+        else:
+            demos.append(spec)
+
+    # Sort, and get rid of duplicates.
+    return sorted(set(os.path.abspath(demo) for demo in demos))
+
+
+def run_demo(path: str, keep_going: bool, load_init: bool, persistent: bool,
+             trace_dir: Optional[str]=None) -> Dict[str, Any]:
+    # Run a single demo. This runs in a worker process, so we're free to
+    # point our stdout and stderr at a capture file, and to chdir to the
+    # demo's directory so that its imports work.
+    result: Dict[str, Any] = {
+        "path": path,
+        "commands": [],
+    }
+
+    capture = tempfile.TemporaryFile()
+
+    # Commands in a suite get no input.
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    saved = [ os.dup(1), os.dup(2) ]
+    saved_cwd = os.getcwd()
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(capture.fileno(), 1)
+    os.dup2(capture.fileno(), 2)
+
+    started = time.perf_counter()
+    shellstate: Optional[RecordingShellState] = None
+    tracer: Optional[Tracer] = None
+
+    if trace_dir:
+        # Name traces after the demo's path, so demos with the same name in
+        # different directories don't collide.
+        name = path.strip(os.sep).replace(os.sep, "_")
+        tracer = Tracer(os.path.join(trace_dir, name))
+
+    try:
+        os.chdir(os.path.dirname(path))
+
+        mode = "markdown" if path.lower().endswith(".md") else "shell"
+
+        shellstate = RecordingShellState("demosh", path, [], 1, persistent=persistent)
+        shellstate.stdin = devnull
+        shellstate.exit_on_failure = not keep_going
+
+        with open(path, "r") as script:
+            demostate = DemoState(shellstate, mode, script,
+                                  load_init=load_init, batch=True, color=False,
+                                  input_fd=shellstate.stdin, tracer=tracer)
+            demostate.run()
+
+        result["status"] = "failed" if shellstate.failures else "passed"
+        result["failures"] = shellstate.failures
+    except Exception:
+        traceback.print_exc()
+        result["status"] = "error"
+        result["failures"] = shellstate.failures if shellstate else 0
+    finally:
+        if shellstate is not None:
+            shellstate.close()
+
+        if tracer is not None:
+            tracer.close()
+
+        result["seconds"] = time.perf_counter() - started
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+        os.close(devnull)
+        os.chdir(saved_cwd)
+
+    capture.seek(0)
+    output = capture.read()
+    capture.close()
+
+    result["output"] = output.decode('utf-8', errors='replace')
+
+    if shellstate is not None:
+        for record in shellstate.records:
+            # A command that never finished (because of an exception) has
+            # no end or rc.
+            end = record.get("end", len(output))
+
+            result["commands"].append({
+                "command": record["command"],
+                "rc": record.get("rc", None),
+                "seconds": record.get("seconds", 0.0),
+                "output": output[record["start"]:end].decode('utf-8', errors='replace'),
+            })
+
+    return result
+
+
+def junit_report(results: List[Dict[str, Any]], seconds: float) -> ET.ElementTree:
+    # One testsuite per demo, one testcase per command.
+    testsuites = ET.Element("testsuites", name="demosh-suite", time=f"{seconds:.3f}")
+
+    for result in results:
+        commands = result["commands"]
+        failed = [ c for c in commands if c["rc"] not in (0, None) ]
+
+        testsuite = ET.SubElement(testsuites, "testsuite",
+                                  name=result["path"],
+                                  tests=str(len(commands)),
+                                  failures=str(len(failed)),
+                                  errors="1" if result["status"] == "error" else "0",
+                                  time=f"{result['seconds']:.3f}")
+
+        for i, command in enumerate(commands):
+            first = command["command"].split("\n", 1)[0]
+
+            testcase = ET.SubElement(testsuite, "testcase",
+                                     classname=result["path"],
+                                     name=f"{i + 1:03d}: {first}",
+                                     time=f"{command['seconds']:.3f}")
+
+            if command["rc"] not in (0, None):
+                failure = ET.SubElement(testcase, "failure", message=f"exit status {command['rc']}")
+                failure.text = command["output"]
+
+            ET.SubElement(testcase, "system-out").text = command["output"]
+
+        if result["status"] == "error":
+            error = ET.SubElement(testsuite, "error", message="demosh error")
+            error.text = result["output"]
+
+    return ET.ElementTree(testsuites)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Run many demosh demos in batch mode, in parallel')
+
+    parser.add_argument('--version', action='version', version=f"%(prog)s {__version__}")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="how many demos to run at once (default: number of CPUs)")
+    parser.add_argument('--keep-going', action='store_true',
+                        help="keep running each demo after a command fails")
+    parser.add_argument('--init', action='store_true', help="run ~/.demoshrc for each demo")
+    parser.add_argument('--persistent-shell', action='store_true',
+                        help="run each demo's commands in a single long-lived bash")
+    parser.add_argument('--trace-dir', type=str, default=None,
+                        help="write a step trace (JSON Lines and Chrome trace) for each demo here")
+    parser.add_argument('--json', type=str, default=None, help="write a JSON report here")
+    parser.add_argument('--junit', type=str, default=None, help="write a JUnit XML report here")
+
+    parser.add_argument('demos', type=str, nargs='+', help="demos to run: files, directories, or globs")
+
+    args = parser.parse_args()
+
+    demos = find_demos(args.demos)
+
+    if args.trace_dir:
+        args.trace_dir = os.path.abspath(args.trace_dir)
+        os.makedirs(args.trace_dir, exist_ok=True)
+
+    if not demos:
+        print("No demos found")
+        sys.exit(1)
+
+    started = time.perf_counter()
+    results: List[Dict[str, Any]] = []
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        futures = {
+            executor.submit(run_demo, demo, args.keep_going, args.init, args.persistent_shell,
+                            args.trace_dir): demo
+            for demo in demos
+        }
+
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results.append(result)
+
+            print(f"{result['status'].upper():6s} {result['seconds']:8.2f}s {result['path']}")
+            sys.stdout.flush()
+
+    seconds = time.perf_counter() - started
+    results.sort(key=lambda r: r["path"])
+
+    passed = len([ r for r in results if r["status"] == "passed" ])
+    print(f"\n{passed}/{len(results)} demos passed in {seconds:.2f}s")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({ "seconds": seconds, "demos": results }, f, indent=2)
+
+    if args.junit:
+        tree = junit_report(results, seconds)
+        ET.indent(tree)
+        tree.write(args.junit, encoding="unicode", xml_declaration=True)
+
+    if passed != len(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+from typing import Any, Dict, List, Optional
+
+import codecs
+import os
+import select
+import termios
+
+
+# A Terminal keeps track of what mode the terminal is in, so that switching
+# to a mode we're already in costs nothing. DemoState keeps the terminal in
+# "raw" mode (no echo, no line buffering, nonblocking reads) the whole time
+# it's typing things out and waiting for keys, and only switches back to
+# "sane" mode when a child process is about to run.
+#
+# If it's not enabled (or fd isn't a terminal), it never touches the
+# terminal at all.
+#
+# We also read keystrokes in bulk, rather than one os.read per key, and hand
+# them out one at a time.
+class Terminal:
+    LFLAG = 3
+    CC = 6
+
+    def __init__(self, fd: int, enabled: bool=True) -> None:
+        self.fd = fd
+        self.mode: Optional[str] = None
+        self._modes: Dict[str, List[Any]] = {}
+        self._keys = ""
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+        # Instrumentation: how many times did we actually switch into each
+        # mode, and how many switches did we skip?
+        self.switches: Dict[str, int] = {}
+        self.skipped = 0
+
+        if enabled and os.isatty(fd):
+            sane = termios.tcgetattr(fd)
+
+            cbreak = termios.tcgetattr(fd)
+            cbreak[Terminal.LFLAG] = cbreak[Terminal.LFLAG] & ~termios.ICANON & ~termios.ECHO
+
+            raw = termios.tcgetattr(fd)
+            raw[Terminal.LFLAG] = raw[Terminal.LFLAG] & ~termios.ICANON & ~termios.ECHO
+            raw[Terminal.CC][termios.VMIN] = 0
+            raw[Terminal.CC][termios.VTIME] = 0
+
+            self._modes = {
+                "sane": sane,
+                "cbreak": cbreak,
+                "raw": raw,
+            }
+
+            # We start out sane, since that's what we just read.
+            self.mode = "sane"
+
+    def set_mode(self, mode: str) -> None:
+        attrs = self._modes.get(mode, None)
+
+        if attrs is None:
+            # Not a terminal, so there's nothing to do.
+            return
+
+        if mode == self.mode:
+            self.skipped += 1
+            return
+
+        # TCSANOW rather than TCSADRAIN: none of our mode changes affect how
+        # output already written gets processed, so there's no reason to
+        # wait for all of it to be transmitted first.
+        termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+
+        self.mode = mode
+        self.switches[mode] = self.switches.get(mode, 0) + 1
+
+    def sane(self) -> None:
+        self.set_mode("sane")
+
+    def cbreak(self) -> None:
+        self.set_mode("cbreak")
+
+    def raw(self) -> None:
+        self.set_mode("raw")
+
+    def restore(self) -> None:
+        # Put the terminal back the way we found it, waiting for output to
+        # drain this time, since we're exiting.
+        attrs = self._modes.get("sane", None)
+
+        if attrs is not None:
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, attrs)
+            self.mode = "sane"
+
+    def read_key(self, timeout: Optional[float]=None) -> Optional[str]:
+        # Return the next key pressed, waiting at most timeout seconds for it
+        # (or forever, if timeout is None). Returns None on timeout or EOF.
+        while not self._keys:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+
+            if not ready:
+                return None
+
+            data = os.read(self.fd, 1024)
+
+            if not data:
+                return None
+
+            self._keys += self._decoder.decode(data)
+
+            if timeout is not None:
+                # Only one wait for a timeout. (A partial UTF-8 sequence
+                # will get finished up next time.)
+                break
+
+        if not self._keys:
+            return None
+
+        ch = self._keys[0]
+        self._keys = self._keys[1:]
+        return ch
+
+    def stats(self) -> str:
+        switches = " ".join(f"{mode}={count}" for mode, count in sorted(self.switches.items()))
+        return f"terminal mode switches: {switches or 'none'} (skipped {self.skipped})"
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+from typing import Any, Dict, List, Optional, TextIO
+
+import json
+import os
+import resource
+import time
+
+
+# A Step is one command as DemoState runs it: typing it out and waiting for
+# the presenter, then executing it, then maybe waiting again.
+class Step:
+    def __init__(self, index: int, level: int, command: str) -> None:
+        self.index = index
+        self.level = level
+        self.command = command
+        self.rc: Optional[int] = None
+
+        self.start = time.perf_counter()
+        self.end = self.start
+        self.exec_start: Optional[float] = None
+        self.exec_end: Optional[float] = None
+
+        self._usage_before: Optional[resource.struct_rusage] = None
+        self._usage_after: Optional[resource.struct_rusage] = None
+
+    def executing(self) -> None:
+        self._usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.exec_start = time.perf_counter()
+
+    def executed(self, rc: int) -> None:
+        self.exec_end = time.perf_counter()
+        self._usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.rc = rc
+
+    def record(self, epoch: float) -> Dict[str, Any]:
+        wall = self.end - self.start
+        exec_time = 0.0
+
+        if (self.exec_start is not None) and (self.exec_end is not None):
+            exec_time = self.exec_end - self.exec_start
+
+        record: Dict[str, Any] = {
+            "index": self.index,
+            "level": self.level,
+            "command": self.command,
+            "start": self.start - epoch,
+            "wall": wall,
+            "wait": wall - exec_time,
+            "exec": exec_time,
+            "rc": self.rc,
+        }
+
+        before = self._usage_before
+        after = self._usage_after
+
+        if (before is not None) and (after is not None):
+            # Child CPU is a sum, so the delta is what this step used. Max
+            # RSS is a high-water mark across all children, so the best we
+            # can say is how far this step raised it.
+            record["child_user"] = after.ru_utime - before.ru_utime
+            record["child_sys"] = after.ru_stime - before.ru_stime
+            record["child_maxrss_kb"] = after.ru_maxrss
+            record["child_maxrss_delta_kb"] = after.ru_maxrss - before.ru_maxrss
+
+        return record
+
+
+# A Tracer records a Step for every command run, and writes them out as JSON
+# Lines (one record per step, written as soon as the step finishes) and as a
+# Chrome trace-event file (written when the Tracer is closed), which you can
+# load into chrome://tracing or https://ui.perfetto.dev.
+class Tracer:
+    def __init__(self, prefix: str) -> None:
+        self.jsonl_path = f"{prefix}.jsonl"
+        self.chrome_path = f"{prefix}.trace.json"
+
+        self.epoch = time.perf_counter()
+        self.steps = 0
+        self.events: List[Dict[str, Any]] = []
+        self._jsonl: Optional[TextIO] = open(self.jsonl_path, "w")
+
+    def start(self, level: int, command: str) -> Step:
+        self.steps += 1
+        return Step(self.steps, level, command)
+
+    def finish(self, step: Step) -> None:
+        step.end = time.perf_counter()
+        record = step.record(self.epoch)
+
+        if self._jsonl is not None:
+            self._jsonl.write(json.dumps(record) + "\n")
+            self._jsonl.flush()
+
+        # Chrome trace events use microseconds. We put each nesting level on
+        # its own thread, so that macros show up nested under their callers.
+        pid = os.getpid()
+        first = step.command.split("\n", 1)[0]
+
+        self.events.append({
+            "name": first,
+            "cat": "step",
+            "ph": "X",
+            "ts": record["start"] * 1e6,
+            "dur": record["wall"] * 1e6,
+            "pid": pid,
+            "tid": step.level,
+            "args": record,
+        })
+
+        if (step.exec_start is not None) and (step.exec_end is not None):
+            self.events.append({
+                "name": "exec",
+                "cat": "exec",
+                "ph": "X",
+                "ts": (step.exec_start - self.epoch) * 1e6,
+                "dur": record["exec"] * 1e6,
+                "pid": pid,
+                "tid": step.level,
+            })
+
+    def close(self) -> None:
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
+
+        with open(self.chrome_path, "w") as f:
+            json.dump({ "traceEvents": self.events, "displayTimeUnit": "ms" }, f)
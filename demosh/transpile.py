@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+from typing import List, Set, TYPE_CHECKING
+
+import os
+import re
+import shlex
+
+from .shellstate import parse_waitfor, reAssignment, reFunction
+
+if TYPE_CHECKING:
+    from .compiler import Instruction
+    from .demostate import DemoState
+
+
+# #@waitfor becomes a call to this: poll with exponential backoff until the
+# condition succeeds or we time out.
+WaitforFunction = [
+    "__demosh_waitfor() {",
+    "    local deadline=$((SECONDS + $1)) delay=1",
+    "    until ( eval \"$2\" ) > /dev/null 2>&1; do",
+    "        if [ \"$SECONDS\" -ge \"$deadline\" ]; then",
+    "            echo \"timed out waiting for $2\" >&2",
+    "            return 1",
+    "        fi",
+    "        sleep $delay",
+    "        [ $delay -lt 5 ] && delay=$((delay * 2))",
+    "    done",
+    "}",
+]
+
+# A Transpiler turns a parsed demo into a single standalone bash script that
+# does the same work as running the demo, minus the presentation: no
+# commentary, no waiting, no typeout. Everything runs in one shell, so
+# functions, assignments, and cds carry over just like they do in demosh.
+#
+# Macros get expanded inline wherever they're called, #@import has already
+# been handled by the parser, and #@ifhook gets resolved right now, against
+# the hooks that are set up as we compile -- so the output is specific to
+# the DEMO_HOOK_* variables that were set when it was compiled.
+class Transpiler:
+    def __init__(self, keep_print: bool=False) -> None:
+        self.keep_print = keep_print
+        self.lines: List[str] = []
+
+        self._waitfor_defined = False
+
+        # Macros we're in the middle of expanding, so that we can catch a
+        # macro that calls itself instead of recursing forever.
+        self._expanding: Set[str] = set()
+
+    def transpile(self, demostate: 'DemoState') -> str:
+        shellstate = demostate.shellstate
+
+        self.lines = [
+            "#!/usr/bin/env bash",
+            f"# Compiled by demosh from {os.path.basename(shellstate.env['0'])}.",
+            "",
+        ]
+
+        # Hook functions get defined while parsing, rather than by running
+        # anything, so they have to go at the top.
+        if len(shellstate.prelude):
+            self.lines.extend(shellstate.prelude.definitions())
+            self.lines.append("")
+
+        self.emit_demostate(demostate)
+
+        return "\n".join(self.lines) + "\n"
+
+    @staticmethod
+    def job_var(name: str) -> str:
+        # The shell variable that holds the PID of the background job name.
+        return "__demosh_job_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+    def emit_demostate(self, demostate: 'DemoState') -> None:
+        demostate.read_all()
+
+        for instr in demostate.instructions:
+            self.emit(demostate, instr)
+
+    def emit(self, demostate: 'DemoState', instr: 'Instruction') -> None:
+        cmd = instr.cmd
+        assert cmd is not None      # hush, mypy
+
+        if instr.op == "ifhook":
+            if cmd.cmdline in demostate.shellstate._hooks:
+                assert cmd.demostate is not None    # hush, mypy
+                self.emit_demostate(cmd.demostate)
+
+        elif instr.op == "parallel":
+            # Run each command in the block in the background, then wait for
+            # each of them by PID -- not with a bare wait, which would also
+            # wait for any background jobs, and which always succeeds. Like
+            # demosh, the block fails if any of its commands did.
+            assert cmd.demostate is not None    # hush, mypy
+            cmd.demostate.read_all()
+
+            started = False
+
+            for binstr in cmd.demostate.instructions:
+                if (binstr.op == "exec") and (binstr.cmd is not None):
+                    cmdline = binstr.cmd.cmdline
+
+                    if binstr.cmd.ismeta():
+                        cmdline = cmdline[2:]
+
+                    if not started:
+                        self.lines.append("__demosh_pids=()")
+                        started = True
+
+                    self.lines.append(f"( {cmdline.rstrip()}\n) & __demosh_pids+=($!)")
+
+            if started:
+                self.lines.extend([
+                    "__demosh_rc=0",
+                    'for __demosh_pid in "${__demosh_pids[@]}"; do',
+                    '    wait "$__demosh_pid" || __demosh_rc=1',
+                    "done",
+                    "[ $__demosh_rc -eq 0 ]",
+                ])
+
+        elif instr.op == "exec":
+            cmdline = cmd.cmdline
+
+            if cmd.ismeta():
+                cmdline = cmdline[2:]
+
+            if cmd.background and not cmd.prefetch:
+                var = Transpiler.job_var(cmd.background)
+                self.lines.append(f"( {cmdline.rstrip()}\n) & {var}=$!")
+            else:
+                self.emit_command(demostate, cmdline.rstrip())
+
+        # Everything else (blank lines, commentary, typeout, and flags like
+        # #@SHOW and #@HIDE) is just presentation.
+
+    def emit_command(self, demostate: 'DemoState', cmdline: str) -> None:
+        # This mirrors ShellState.run and ShellState.run_command.
+        m = reAssignment.match(cmdline)
+
+        if m:
+            # demosh exports every variable it sets.
+            self.lines.append(f"export {m.group(2)}={cmdline[m.end(0):]}")
+            return
+
+        m = reFunction.match(cmdline)
+
+        if m:
+            self.lines.append(f"{m.group(2)}() {{" + cmdline[m.end():])
+            return
+
+        try:
+            fields = shlex.split(cmdline)
+        except ValueError:
+            # demosh can't run this either, so let bash complain about it.
+            self.lines.append(cmdline)
+            return
+
+        if not fields:
+            return
+
+        first = fields[0]
+        macros = demostate.shellstate.macros
+
+        if first in macros:
+            if first in self._expanding:
+                raise Exception(f"Macro {first} calls itself")
+
+            self._expanding.add(first)
+            self.emit_demostate(macros[first])
+            self._expanding.remove(first)
+
+        elif first == "wait":
+            pass
+
+        elif first == "waitfor":
+            condition, timeout = parse_waitfor(cmdline)
+
+            if not self._waitfor_defined:
+                # Define the polling function just before its first use.
+                self.lines.extend(WaitforFunction)
+                self._waitfor_defined = True
+
+            self.lines.append(f"__demosh_waitfor {int(timeout)} {shlex.quote(condition)}")
+
+        elif first == "join":
+            if len(fields) > 1:
+                self.lines.append("wait " + " ".join(f'${{{Transpiler.job_var(name)}:-}}' for name in fields[1:]))
+            else:
+                self.lines.append("wait")
+
+        elif first == "print":
+            if self.keep_print:
+                # Leave $ alone, so that bash expands variables like demosh would.
+                text = " ".join(shlex.split(cmdline[6:]))
+                text = text.replace("\\", "\\\\").replace('"', '\\"').replace("`", "\\`")
+
+                self.lines.append(f'echo "{text}"')
+
+        else:
+            self.lines.append(cmdline)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# SPDX-FileCopyrightText: 2022 Buoyant, Inc.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright 2022 Buoyant, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.  You may obtain
+# a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#--------------------------------------
+#
+# For more info, see README.md. If you've somehow found demosh without also
+# finding its repo, it's at github.com/BuoyantIO/demosh.
+
+from typing import Callable, List, Optional, Set, Tuple, TYPE_CHECKING
+
+import sys
+
+import bisect
+import random
+import time
+
+if TYPE_CHECKING:
+    from .terminal import Terminal
+
+
+# A Typeout types text out "by hand", the way DemoState.display_slowly shows
+# commands. Rather than writing, flushing, and sleeping once per character,
+# it works out when every character should appear before it starts, then
+# writes everything that's due in one go, and waits for a key (so that we
+# notice early keypresses) until the next character is due. If we fall
+# behind (a slow terminal, or a slow link to it), we catch up with one write
+# rather than stuttering through the backlog.
+class Typeout:
+    # By default, each character takes between 10ms and 100ms, which works
+    # out to about 18 characters per second.
+    DefaultRate = 1.0 / 0.055
+
+    def __init__(self, rate: Optional[float]=None, seed: Optional[int]=None) -> None:
+        if not rate:
+            rate = Typeout.DefaultRate
+
+        self.rate = rate
+
+        # Delays are uniformly distributed between these, scaled so that the
+        # average works out to our rate.
+        scale = (1.0 / rate) / 0.055
+        self.min_delay = 0.01 * scale
+        self.max_delay = 0.1 * scale
+
+        self.random = random.Random(seed)
+
+    def schedule(self, count: int) -> List[float]:
+        # Return when each of count characters should be written, in seconds
+        # from the start, plus when we're done after the last one.
+        deadlines: List[float] = []
+        when = 0.0
+
+        for delay in [ self.random.uniform(self.min_delay, self.max_delay) for _ in range(count) ]:
+            deadlines.append(when)
+            when += delay
+
+        deadlines.append(when)
+        return deadlines
+
+    def type(self, text: str, terminal: 'Terminal', interrupts: Set[str],
+             write: Optional[Callable[[str], None]]=None) -> Tuple[str, int]:
+        # Type text out. If a key in interrupts is pressed, stop early. We
+        # return the key that was pressed (or "" if none was), and how many
+        # characters of text were written.
+        if write is None:
+            write = Typeout.write
+
+        count = len(text)
+        deadlines = self.schedule(count)
+        start = time.monotonic()
+        written = 0
+
+        while True:
+            now = time.monotonic() - start
+
+            # Write everything that's due, all at once.
+            due = min(bisect.bisect_right(deadlines, now, lo=written), count)
+
+            if due > written:
+                write(text[written:due])
+                written = due
+
+            remaining = deadlines[written] - (time.monotonic() - start)
+
+            if (written >= count) and (remaining <= 0):
+                break
+
+            # We're waiting for a key here both to check for early input
+            # _and_ for the delay until the next character.
+            ch = terminal.read_key(max(remaining, 0))
+
+            if ch and (ch in interrupts):
+                # Early input that's interesting, so stop.
+                return ch, written
+
+        return "", written
+
+    @staticmethod
+    def write(text: str) -> None:
+        sys.stdout.write(text)
+        sys.stdout.flush()